@@ -72,3 +72,5 @@ def downgrade() -> None:
     op.drop_table('user')
     op.drop_table('message')
     # ### end Alembic commands ###
+    # PostgreSQL keeps enum types after their tables are dropped, upgrading again would fail to create it
+    sa.Enum(name='status').drop(op.get_bind(), checkfirst=True)
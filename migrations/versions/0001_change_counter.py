@@ -0,0 +1,30 @@
+"""Change counter
+
+Revision ID: 0001
+Revises: 0000
+Create Date: 2026-10-18 10:12:41.201874
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001'
+down_revision = '0000'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    change_counter = op.create_table('change_counter',
+    sa.Column('name', sa.Enum('FILTERS', name='countername'), nullable=False),
+    sa.Column('value', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(change_counter, [{'name': 'FILTERS', 'value': 0}])
+
+
+def downgrade() -> None:
+    op.drop_table('change_counter')
+    sa.Enum(name='countername').drop(op.get_bind(), checkfirst=True)
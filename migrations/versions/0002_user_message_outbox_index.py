@@ -0,0 +1,24 @@
+"""User message outbox index
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 13:20:05.418309
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_user_message_processed_date', 'user_message', ['processed', 'date'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_user_message_processed_date', table_name='user_message')
@@ -0,0 +1,28 @@
+"""User chat cache
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 13:25:47.902114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.execute("ALTER TYPE countername ADD VALUE IF NOT EXISTS 'USER_CHATS'")
+    op.create_index('ix_chat_user_user_id_time_created', 'chat_user', ['user_id', 'time_created'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_chat_user_user_id_time_created', table_name='chat_user')
+    op.execute(sa.text("DELETE FROM change_counter WHERE name = 'USER_CHATS'"))
@@ -0,0 +1,31 @@
+"""Filter indexes
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 13:40:12.583021
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        'ix_filter_user_id_status_time_created', 'filter', ['user_id', 'status', 'time_created'], unique=False
+    )
+    op.create_index(
+        'ix_filter_active', 'filter', ['user_id', 'filter_id', 'filter_'], unique=False,
+        sqlite_where=sa.text("status = 'ACTIVE'"), postgresql_where=sa.text("status = 'ACTIVE'")
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_filter_active', table_name='filter')
+    op.drop_index('ix_filter_user_id_status_time_created', table_name='filter')
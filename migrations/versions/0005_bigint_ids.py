@@ -0,0 +1,42 @@
+"""Bigint ids
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 14:52:06.137490
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+# Telegram ids do not fit 32 bits, SQLite integers are 64 bit already
+COLUMNS = [
+    ('user', 'user_id'),
+    ('chat_user', 'chat_id'),
+    ('chat_user', 'user_id'),
+    ('filter', 'user_id'),
+    ('message', 'message_id'),
+    ('message', 'channel_id'),
+    ('user_message', 'user_id'),
+    ('user_message', 'message_id'),
+]
+
+
+def upgrade() -> None:
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    for table, column in COLUMNS:
+        op.alter_column(table, column, type_=sa.BigInteger(), existing_type=sa.Integer())
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    for table, column in reversed(COLUMNS):
+        op.alter_column(table, column, type_=sa.Integer(), existing_type=sa.BigInteger())
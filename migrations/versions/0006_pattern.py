@@ -0,0 +1,65 @@
+"""Pattern
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 16:08:33.746215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+ACTIVE = sa.text("status = 'ACTIVE'")
+
+
+def upgrade() -> None:
+    op.create_table('pattern',
+    sa.Column('pattern_id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('pattern', sa.String(), nullable=False),
+    sa.Column('time_created', sa.DateTime(timezone=True), server_default=sa.text('(CURRENT_TIMESTAMP)'), nullable=False),
+    sa.PrimaryKeyConstraint('pattern_id'),
+    sa.UniqueConstraint('pattern')
+    )
+    op.execute(sa.text("INSERT INTO pattern (pattern) SELECT DISTINCT filter_ FROM filter"))
+
+    op.drop_index('ix_filter_active', table_name='filter')
+    with op.batch_alter_table('filter') as batch_op:
+        batch_op.add_column(sa.Column('pattern_id', sa.Integer(), nullable=True))
+    op.execute(sa.text(
+        "UPDATE filter SET pattern_id = (SELECT pattern.pattern_id FROM pattern WHERE pattern.pattern = filter.filter_)"
+    ))
+    with op.batch_alter_table('filter') as batch_op:
+        batch_op.alter_column('pattern_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.create_foreign_key('fk_filter_pattern_id_pattern', 'pattern', ['pattern_id'], ['pattern_id'])
+        batch_op.drop_column('filter_')
+
+    op.create_index(
+        'ix_filter_active_pattern_id_user_id', 'filter', ['pattern_id', 'user_id'], unique=False,
+        sqlite_where=ACTIVE, postgresql_where=ACTIVE
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_filter_active_pattern_id_user_id', table_name='filter')
+
+    with op.batch_alter_table('filter') as batch_op:
+        batch_op.add_column(sa.Column('filter_', sa.String(), nullable=True))
+    op.execute(sa.text(
+        "UPDATE filter SET filter_ = (SELECT pattern.pattern FROM pattern WHERE pattern.pattern_id = filter.pattern_id)"
+    ))
+    with op.batch_alter_table('filter') as batch_op:
+        batch_op.alter_column('filter_', existing_type=sa.String(), nullable=False)
+        batch_op.drop_constraint('fk_filter_pattern_id_pattern', type_='foreignkey')
+        batch_op.drop_column('pattern_id')
+
+    op.create_index(
+        'ix_filter_active', 'filter', ['user_id', 'filter_id', 'filter_'], unique=False,
+        sqlite_where=ACTIVE, postgresql_where=ACTIVE
+    )
+    op.drop_table('pattern')
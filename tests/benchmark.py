@@ -0,0 +1,579 @@
+"""Offline benchmarks of the hot paths: filter matching, queues between processes and crud fan-out
+
+    python -m tests.benchmark --output before.json
+    python -m tests.benchmark --output after.json --compare before.json
+
+Every run uses synthetic data generated from a fixed seed and a temporary SQLite database,
+results are written as JSON, one record per suite and parameters, so runs of different commits can be compared.
+"""
+import argparse
+import asyncio
+import atexit
+import dataclasses
+import gc
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+_ROOT = Path(__file__).parent.parent
+_DB_FILE = os.environ.get("TG_FILTERING_BOT_BENCHMARK_DB")
+if _DB_FILE is None:
+    _db_dir = tempfile.mkdtemp(prefix="tg_filtering_bot_benchmark_")
+    atexit.register(shutil.rmtree, _db_dir, ignore_errors=True)
+    # Child processes of the benchmark use the same database
+    _DB_FILE = os.environ["TG_FILTERING_BOT_BENCHMARK_DB"] = str(Path(_db_dir) / "benchmark.db")
+
+# Settings are read on import, the benchmark never talks to Telegram and never touches the real database
+for _name, _value in {
+    "LISTENER_API_ID": "0",
+    "LISTENER_API_HASH": "benchmark",
+    "LISTENER_API_NAME": "benchmark",
+    "LISTENER_PHONE": "0",
+    "LISTENER_PASSWORD": "benchmark",
+    "LISTENER_CHANNEL_ID": "0",
+    "BOT_TOKEN": "0:benchmark",
+}.items():
+    os.environ.setdefault(_name, _value)
+os.environ["SQLALCHEMY_DATABASE_URI"] = "sqlite+aiosqlite:///" + _DB_FILE
+
+from sqlalchemy import event, func, insert, select  # noqa: E402
+from sqlalchemy.exc import OperationalError  # noqa: E402
+
+from tg_filtering_bot.async_queue import AsyncQueue  # noqa: E402
+from tg_filtering_bot.config import settings  # noqa: E402
+from tg_filtering_bot.crud import crud  # noqa: E402
+from tg_filtering_bot.crud.db import (  # noqa: E402
+    async_session, engine, Base, ChatUser, CounterName, Filter, Pattern, Status, User, _engine_options
+)
+from tg_filtering_bot.crud.dto import ForwardMessageDTO, QueueMessageDTO, UserChatDTO, UserFilterDTO  # noqa: E402
+from tg_filtering_bot.crud.schema import ChatId, UserId  # noqa: E402
+from tg_filtering_bot.crud.query_log import normalize_statement  # noqa: E402
+from tg_filtering_bot.matcher import FilterIndex, group_filters  # noqa: E402
+from tg_filtering_bot.synthetic import SEED, make_filters, make_messages  # noqa: E402
+
+Result = Dict[str, Any]
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+def _timings(values: List[float]) -> Dict[str, float]:
+    """Milliseconds"""
+    return {
+        "p50_ms": statistics.median(values) * 1000,
+        "p99_ms": _percentile(values, 99) * 1000,
+        "mean_ms": statistics.fmean(values) * 1000,
+    }
+
+
+def bench_matcher(filter_counts: Iterable[int], messages: int, regex_share: float) -> List[Result]:
+    results = []
+    for count in filter_counts:
+        rng = random.Random(SEED)
+        filters = make_filters(count, regex_share, users=max(1, count // 3), rng=rng)
+        texts = [m.message for m in make_messages(messages, rng)]
+
+        started = time.perf_counter()
+        index = FilterIndex(group_filters(filters))
+        build_seconds = time.perf_counter() - started
+
+        durations = []
+        matches = 0
+        for text in texts:
+            started = time.perf_counter()
+            matches += len(index.match_text(text))
+            durations.append(time.perf_counter() - started)
+
+        results.append({
+            "suite": "matcher",
+            "params": {"filters": count, "regex_share": regex_share, "messages": messages},
+            "metrics": {
+                "build_seconds": build_seconds,
+                "messages_per_second": len(texts) / sum(durations),
+                "matches_per_message": matches / len(texts),
+                **_timings(durations),
+            },
+        })
+    return results
+
+
+def _traced(build: Callable[[], Any]) -> Tuple[Any, int, int]:
+    """Result of the call, bytes it allocated and kept and objects it added to the garbage collector"""
+    gc.collect()
+    objects = len(gc.get_objects())
+    tracemalloc.start()
+    try:
+        value = build()
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return value, size, len(gc.get_objects()) - objects
+
+
+def bench_memory(subscription_counts: Iterable[int], recipients: int) -> List[Result]:
+    """Memory of active patterns and the filter index per subscription, and of fan-out per recipient"""
+    results = []
+    for count in subscription_counts:
+        rng = random.Random(SEED)
+        filters = make_filters(count, 0.1, users=max(1, count // 3), rng=rng)
+        patterns, patterns_bytes, patterns_objects = _traced(lambda: group_filters(filters))
+        index, index_bytes, index_objects = _traced(lambda: FilterIndex(patterns))
+
+        results.append({
+            "suite": "memory",
+            "params": {"subscriptions": count},
+            "metrics": {
+                "patterns": len(patterns),
+                "pattern_bytes_per_subscription": patterns_bytes / count,
+                "index_bytes_per_subscription": index_bytes / count,
+                "gc_objects_per_subscription": (patterns_objects + index_objects) / count,
+            },
+        })
+
+    message = make_messages(1, random.Random(SEED))[0]
+    user_chats, chats_bytes, chats_objects = _traced(lambda: [
+        UserChatDTO(user_id=UserId(user_id), chat_id=ChatId(user_id), name=f"user{user_id}",
+                    username=f"user{user_id}", language_code="ru")
+        for user_id in range(1, recipients + 1)
+    ])
+    enqueued_at = time.time()
+    _, forward_bytes, forward_objects = _traced(lambda: [
+        ForwardMessageDTO(message=message, user_chat=user_chat, enqueued_at=enqueued_at) for user_chat in user_chats
+    ])
+    results.append({
+        "suite": "memory_fan_out",
+        "params": {"recipients": recipients},
+        "metrics": {
+            "user_chat_bytes_per_recipient": chats_bytes / recipients,
+            "forward_bytes_per_recipient": forward_bytes / recipients,
+            "gc_objects_per_recipient": (chats_objects + forward_objects) / recipients,
+        },
+    })
+    return results
+
+
+def _echo(inbox: AsyncQueue, outbox: AsyncQueue) -> None:
+    async def echo() -> None:
+        while True:
+            await outbox.put_many(await inbox.get_batch(settings.QUEUE_MAX_BATCH))
+
+    asyncio.run(echo())
+
+
+async def _round_trips(outbox: AsyncQueue, inbox: AsyncQueue, count: int) -> List[float]:
+    durations = []
+    message = make_messages(1, random.Random(SEED))[0]
+    for _ in range(count):
+        started = time.perf_counter()
+        await outbox.put(message)
+        await inbox.get()
+        durations.append(time.perf_counter() - started)
+    return durations
+
+
+async def _transfer(outbox: AsyncQueue, inbox: AsyncQueue, count: int, batch: int) -> float:
+    messages = make_messages(batch, random.Random(SEED))
+
+    async def produce() -> None:
+        for _ in range(0, count, batch):
+            if batch == 1:
+                await outbox.put(messages[0])
+            else:
+                await outbox.put_many(messages)
+
+    started = time.perf_counter()
+    producer = asyncio.ensure_future(produce())
+    received = 0
+    while received < count:
+        received += len(await inbox.get_batch(settings.QUEUE_MAX_BATCH))
+    await producer
+    return time.perf_counter() - started
+
+
+def bench_queue(round_trips: int, items: int, batches: Iterable[int]) -> List[Result]:
+    """Messages go to a child process and back, as between the channel client, the service and the bot"""
+    to_child: AsyncQueue = AsyncQueue(multiprocessing.Queue(maxsize=settings.QUEUE_SIZE))
+    from_child: AsyncQueue = AsyncQueue(multiprocessing.Queue(maxsize=settings.QUEUE_SIZE))
+    process = multiprocessing.Process(target=_echo, args=(to_child, from_child), daemon=True)
+    process.start()
+
+    async def run() -> List[Result]:
+        durations = await _round_trips(to_child, from_child, round_trips)
+        results = [{
+            "suite": "queue_latency",
+            "params": {"round_trips": round_trips},
+            "metrics": {"hop_" + k: v / 2 for k, v in _timings(durations).items()},
+        }]
+        for batch in batches:
+            elapsed = await _transfer(to_child, from_child, items, batch)
+            results.append({
+                "suite": "queue_throughput",
+                "params": {"items": items, "batch": batch},
+                "metrics": {"items_per_second": items / elapsed},
+            })
+        return results
+
+    try:
+        return asyncio.run(run())
+    finally:
+        process.kill()
+        process.join()
+
+
+def _migrate() -> None:
+    from alembic import command
+    from alembic.config import Config
+
+    config = Config(str(_ROOT / "alembic.ini"))
+    config.set_main_option("script_location", str(_ROOT / "migrations"))
+    command.upgrade(config, "head")
+
+
+async def _create_users(count: int) -> None:
+    async with async_session() as session:
+        if await session.scalar(select(func.count()).select_from(User)):
+            return None
+
+        await session.execute(insert(User), [
+            {"user_id": user_id, "name": f"user{user_id}", "username": f"user{user_id}",
+             "language_code": "ru", "status": Status.ACTIVE}
+            for user_id in range(1, count + 1)
+        ])
+        # An old and a current chat for every user
+        await session.execute(insert(ChatUser), [
+            {"chat_id": chat_id, "user_id": (chat_id - 1) % count + 1,
+             "time_created": datetime(2023, 1, 1 + (chat_id - 1) // count, tzinfo=timezone.utc)}
+            for chat_id in range(1, 2 * count + 1)
+        ])
+        filters = make_filters(3 * count, 0.1, count, random.Random(SEED))
+        pattern_ids = {p.pattern: p.pattern_id + 1 for p in group_filters(filters)}
+        await session.execute(insert(Pattern), [
+            {"pattern_id": pattern_id, "pattern": pattern} for pattern, pattern_id in pattern_ids.items()
+        ])
+        await session.execute(insert(Filter), [
+            {"user_id": f.user_id, "pattern_id": pattern_ids[f.filter_], "status": Status.ACTIVE}
+            for f in filters
+        ])
+        await session.commit()
+
+
+async def _fan_out(message: QueueMessageDTO, user_ids: List[UserId], steps: Dict[str, List[float]]) -> None:
+    """The same calls as MainService makes for a matched message and the bot acknowledgements"""
+    async def step(name: str, call: Callable[[], Any]) -> None:
+        started = time.perf_counter()
+        await call()
+        steps.setdefault(name, []).append(time.perf_counter() - started)
+
+    await step("add_message", lambda: crud.add_message_to_db(message))
+    await step("create_user_messages", lambda: crud.create_user_messages(message.message_id, user_ids))
+    crud._user_chat_cache.clear()
+    await step("latest_chats_cold", lambda: crud.get_latest_user_chats(user_ids))
+    await step("latest_chats_cached", lambda: crud.get_latest_user_chats(user_ids))
+    await step("mark_processed", lambda: crud.mark_user_messages_as_processed(message.message_id, user_ids))
+
+
+def _read_user_data(users: int, duration: float, results: "multiprocessing.Queue[Dict[str, Any]]") -> None:
+    """Reads filters in a loop like the bot process does while the service writes"""
+    engine.echo = False
+
+    async def run() -> None:
+        rng = random.Random(SEED)
+        durations = []
+        errors = 0
+        stop_at = time.monotonic() + duration
+        while time.monotonic() < stop_at:
+            started = time.perf_counter()
+            try:
+                await crud.get_user_filters(UserId(rng.randint(1, users)))
+            except OperationalError:
+                errors += 1
+            durations.append(time.perf_counter() - started)
+        results.put({"reads": len(durations), "read_errors": errors, **_timings(durations)})
+
+    asyncio.run(run())
+
+
+async def _contention(users: int, recipients: int, writers: int, duration: float, first_id: int) -> Dict[str, Any]:
+    """Writer tasks fan out messages in this process while another process reads"""
+    context = multiprocessing.get_context("spawn")
+    reads: "multiprocessing.Queue[Dict[str, Any]]" = context.Queue()
+    reader = context.Process(target=_read_user_data, args=(users, duration, reads), daemon=True)
+    reader.start()
+
+    messages = iter(make_messages(100_000, random.Random(SEED), first_id=first_id))
+    written = errors = 0
+
+    async def write(rng: random.Random, stop_at: float) -> None:
+        nonlocal written, errors
+        while time.monotonic() < stop_at:
+            message = next(messages)
+            user_ids = [UserId(u) for u in rng.sample(range(1, users + 1), recipients)]
+            try:
+                await crud.add_message_to_db(message)
+                await crud.create_user_messages(message.message_id, user_ids)
+                await crud.mark_user_messages_as_processed(message.message_id, user_ids)
+                written += 1
+            except OperationalError:
+                errors += 1
+
+    stop_at = time.monotonic() + duration
+    await asyncio.gather(*(write(random.Random(SEED + i), stop_at) for i in range(writers)))
+    read_stats = await asyncio.get_running_loop().run_in_executor(None, reads.get)
+    reader.join()
+
+    return {
+        "messages_per_second": written / duration,
+        "write_errors": errors,
+        **{f"read_{k}": v for k, v in read_stats.items()},
+    }
+
+
+def bench_crud(recipient_counts: List[int], messages: int, writers: int, duration: float) -> List[Result]:
+    _migrate()
+
+    async def run() -> List[Result]:
+        await _create_users(max(recipient_counts))
+
+        rng = random.Random(SEED)
+        results = []
+        first_id = 1
+        for recipients in recipient_counts:
+            steps: Dict[str, List[float]] = {}
+            for message in make_messages(messages, rng, first_id=first_id):
+                user_ids = [UserId(u) for u in rng.sample(range(1, max(recipient_counts) + 1), recipients)]
+                await _fan_out(message, user_ids, steps)
+            first_id += messages
+
+            results.append({
+                "suite": "crud_fan_out",
+                "params": {"recipients": recipients, "messages": messages},
+                "metrics": {
+                    f"{name}_{k}": v for name, durations in steps.items() for k, v in _timings(durations).items()
+                },
+            })
+
+        if duration > 0:
+            recipients = min(recipient_counts)
+            results.append({
+                "suite": "crud_contention",
+                "params": {"writers": writers, "recipients": recipients, "duration": duration},
+                "metrics": await _contention(max(recipient_counts), recipients, writers, duration, first_id),
+            })
+        return results
+
+    return asyncio.run(run())
+
+
+async def _crud_queries() -> None:
+    """Runs every crud query on the hot paths except inserts"""
+    message = make_messages(1, random.Random(SEED), first_id=10**9)[0]
+    await crud.add_message_to_db(message)
+    await crud.create_user_messages(message.message_id, [UserId(1), UserId(2)])
+    # An edit of the message, its text is updated and only the new recipient is added
+    await crud.add_message_to_db(dataclasses.replace(message, message=message.message + " ред."))
+    await crud.create_missing_user_messages(message.message_id, [UserId(1), UserId(3)])
+    created_before = datetime.now(timezone.utc) + timedelta(seconds=1)
+
+    await crud.get_counter(CounterName.FILTERS)
+    await crud.get_active_patterns()
+    await crud.get_user_filters(UserId(1))
+    crud._user_chat_cache.clear()
+    await crud.get_latest_user_chats([UserId(1), UserId(2)])
+    page = await crud.get_pending_user_messages(created_before, limit=1)
+    await crud.get_pending_user_messages(created_before, limit=1, after=page[-1])
+    await crud.mark_user_messages_as_processed(message.message_id, [UserId(1), UserId(2)])
+    await crud.disable_filter(UserFilterDTO(user_id=UserId(1), filter_="", filter_id=1))
+
+
+def _partial_indexes() -> Set[str]:
+    return {
+        index.name
+        for table in Base.metadata.tables.values() for index in table.indexes
+        if index.name and index.dialect_options["sqlite"].get("where") is not None
+    }
+
+
+def _full_scans(plan: List[str]) -> List[str]:
+    """Plan steps reading a whole table or a whole index of it, subqueries and temporary b-trees are fine.
+    A partial index holds only the rows of its condition, e.g. the active filters loaded all at once"""
+    partial = _partial_indexes()
+    scans = []
+    for detail in plan:
+        words = detail.split()
+        if words[0] != "SCAN" or words[1] not in Base.metadata.tables:
+            continue
+        index = words[words.index("INDEX") + 1] if "INDEX" in words else None
+        if index not in partial:
+            scans.append(detail)
+    return scans
+
+
+def check_query_plans(users: int) -> List[Result]:
+    """EXPLAIN QUERY PLAN of the statements crud queries execute, none of them may scan a whole table"""
+    _migrate()
+
+    async def run() -> List[Result]:
+        await _create_users(users)
+
+        statements: List[Any] = []
+
+        def capture(conn: Any, cursor: Any, statement: str, parameters: Any, context: Any, executemany: bool) -> None:
+            if statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+                statements.append((statement, parameters))
+
+        event.listen(engine.sync_engine, "before_cursor_execute", capture)
+        try:
+            await _crud_queries()
+        finally:
+            event.remove(engine.sync_engine, "before_cursor_execute", capture)
+
+        plans = []
+        async with engine.connect() as conn:
+            for statement, parameters in statements:
+                rows = (await conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)).all()
+                plan = [row[-1] for row in rows]
+                plans.append({
+                    "statement": normalize_statement(statement), "plan": plan, "full_scans": _full_scans(plan)
+                })
+
+        return [{
+            "suite": "query_plans",
+            "params": {"users": users},
+            "metrics": {"statements": len(plans), "full_scans": sum(len(p["full_scans"]) for p in plans)},
+            "plans": plans,
+        }]
+
+    return asyncio.run(run())
+
+
+def _database_profile() -> Dict[str, Any]:
+    # Pool settings the engine was created with, SQLite databases have their own
+    return {
+        **_engine_options(),
+        "sqlite_journal_mode": settings.SQLITE_JOURNAL_MODE,
+        "sqlite_synchronous": settings.SQLITE_SYNCHRONOUS,
+        "sqlite_mmap_size": settings.SQLITE_MMAP_SIZE,
+        "sqlite_cache_size": settings.SQLITE_CACHE_SIZE,
+        "sqlite_busy_timeout": settings.SQLITE_BUSY_TIMEOUT,
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: List[Result], baseline: List[Result]) -> None:
+    def key(result: Result) -> str:
+        return result["suite"] + json.dumps(result["params"], sort_keys=True)
+
+    before = {key(r): r for r in baseline}
+    for result in results:
+        old = before.get(key(result))
+        if old is None:
+            continue
+        print(f"{result['suite']} {result['params']}")
+        for name, value in result["metrics"].items():
+            old_value = old["metrics"].get(name)
+            if old_value:
+                print(f"    {name}: {old_value:.4g} -> {value:.4g} ({(value - old_value) / old_value:+.1%})")
+
+
+SUITES = ["matcher", "queue", "crud", "plans", "memory"]
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(",")]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--suite", action="append", choices=SUITES, help="Suites to run, all by default"
+    )
+    parser.add_argument("--filters", type=_int_list, default=[10, 1000, 10_000, 100_000], help="Filter counts")
+    parser.add_argument("--regex-share", type=float, default=0.1, help="Part of filters that are regular expressions")
+    parser.add_argument("--messages", type=int, default=100, help="Messages matched or fanned out per run")
+    parser.add_argument("--round-trips", type=int, default=1000)
+    parser.add_argument("--queue-items", type=int, default=50_000)
+    parser.add_argument("--queue-batches", type=_int_list, default=[1, 64, 256])
+    parser.add_argument("--recipients", type=_int_list, default=[10, 100, 1000, 5000], help="Users per message")
+    parser.add_argument(
+        "--subscriptions", type=_int_list, default=[100_000, 1_000_000], help="Filters in the memory suite"
+    )
+    parser.add_argument("--writers", type=int, default=4, help="Concurrent writers in the contention run")
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds of the contention run, 0 to skip it")
+    parser.add_argument("--output", type=Path, help="JSON file to write results to")
+    parser.add_argument("--compare", type=Path, help="JSON file of a previous run to compare results with")
+    args = parser.parse_args()
+
+    # Measure the code, not the logging
+    logging.getLogger().setLevel(logging.WARNING)
+    engine.echo = False
+
+    suites = args.suite or SUITES
+    results: List[Result] = []
+    if "matcher" in suites:
+        results += bench_matcher(args.filters, args.messages, args.regex_share)
+    if "queue" in suites:
+        results += bench_queue(args.round_trips, args.queue_items, args.queue_batches)
+    if "crud" in suites:
+        results += bench_crud(args.recipients, args.messages, args.writers, args.duration)
+    if "plans" in suites:
+        results += check_query_plans(max(args.recipients))
+    if "memory" in suites:
+        results += bench_memory(args.subscriptions, max(args.recipients))
+
+    report = {
+        "commit": _git_commit(),
+        "time": datetime.now(timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "seed": SEED,
+        "database": _database_profile(),
+        "results": results,
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(text)
+    else:
+        print(text)
+
+    if args.compare:
+        compare(results, json.loads(args.compare.read_text())["results"])
+
+    full_scans = [
+        (plan["statement"], scan)
+        for result in results if result["suite"] == "query_plans"
+        for plan in result["plans"] for scan in plan["full_scans"]
+    ]
+    for statement, scan in full_scans:
+        print(f"Full scan {scan!r} in {statement}", file=sys.stderr)
+    if full_scans:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
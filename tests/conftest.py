@@ -0,0 +1,2 @@
+# Settings are read on import, tests use the placeholder settings and the temporary database of the benchmark
+import tests.benchmark  # noqa: F401
@@ -0,0 +1,126 @@
+import re
+from typing import Dict, Iterable, Optional, Set
+
+import pytest
+
+from tg_filtering_bot.crud.dto import PatternDTO, user_id_array
+from tg_filtering_bot.crud.schema import UserId
+from tg_filtering_bot.matcher import FilterIndex, get_literal, normalize_text
+
+
+def _index(filters: Dict[str, Iterable[int]]) -> FilterIndex:
+    return FilterIndex([
+        PatternDTO(pattern_id=i, pattern=filter_, user_ids=user_id_array(user_ids))
+        for i, (filter_, user_ids) in enumerate(filters.items())
+    ])
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("ул. Ленина, д.5", "улица ленина дом 5"),
+    ("ulitsa Lenina dom 5", "улица ленина дом 5"),
+    ("UL Lenina d 5", "улица ленина дом 5"),
+    # Latin "y", "e" and "a" in Cyrillic words, fullwidth letters
+    ("yл. Лeнинa", "улица ленина"),
+    ("ＵＬ. Ленина", "улица ленина"),
+    ("Королёва", "королева"),
+    ("Pervomayskaya", "первомаиская"),
+    ("Первомайская", "первомаиская"),
+    ("Novyy Arbat", "новыи арбат"),
+    ("Shchorsa", "щорса"),
+    ("пр. Мира", "проспект мира"),
+    ("prospekt Mira", "проспект мира"),
+    ("д. 5 стр. 2", "дом 5 строение 2"),
+    ("d 5 str 2", "дом 5 строение 2"),
+])
+def test_normalize_text(text: str, expected: str) -> None:
+    assert normalize_text(text) == expected
+
+
+@pytest.mark.parametrize("filter_, literal", [
+    ("улица Ленина", "улица ленина"),
+    ("Lenina st", "ленина улица"),
+    # A dot is regex syntax
+    ("ул. Мира", None),
+    ("3.5", None),
+    ("", None),
+])
+def test_get_literal(filter_: str, literal: Optional[str]) -> None:
+    assert get_literal(filter_) == literal
+
+
+@pytest.mark.parametrize("text, user_ids", [
+    ("Сдаётся квартира, ул Ленина 5", {1}),
+    ("ulitsa Lenina", {1}),
+    ("УЛИЦА ЛEНИНА", {1}),
+    ("проспект Ленина", set()),
+    ("улица Мира", set()),
+    ("2-комн. квартира на Королёва", {4}),
+    ("3,5 комнаты", {2}),
+    ("3 5", {2}),
+    ("35", set()),
+    ("ул. Мира 1", {3}),
+    ("ул, Мира", {3}),
+    ("ул Мира", set()),
+])
+def test_match_text(text: str, user_ids: Set[int]) -> None:
+    index = _index({"улица Ленина": [1], "3.5": [2], "ул. Мира": [3], "Королева": [4]})
+    assert index.match_text(text) == {UserId(user_id) for user_id in user_ids}
+
+
+def test_same_literal_of_different_filters() -> None:
+    index = _index({"ул Ленина": [1], "Ulitsa Lenina": [2]})
+    assert index.match_text("улица Ленина") == {1, 2}
+
+    index.sync([PatternDTO(pattern_id=1, pattern="Ulitsa Lenina", user_ids=user_id_array([2]))])
+    assert index.match_text("улица Ленина") == {2}
+
+
+# Regular expressions are searched only when their required literals are in the text
+_REGEX_FILTERS = [
+    "ленина +(д.)?12",
+    "(ленина|мира) 5",
+    "кв(артира)? 7",
+    "[кК]омнат[аы]",
+    "дом ?[0-9]{1,3}",
+    "ab{0,2}cd",
+    "этаж(?: \\d+)?",
+    "^продам",
+    "метро$",
+    "\\bст\\.? м\\.? пушкинская",
+    "(?:1|2|3)-комн",
+    "(?!без )мебель",
+    "(?i)СТУДИЯ",
+    "straße\\b",
+    "[",
+]
+_TEXTS = [
+    "ленина 12", "Ленина  д.12", "ЛЕНИНА д12", "ленина д 12",
+    "мира 5", "ленина 5", "лермонтова 5",
+    "квартира 7", "кв 7", "кв.7",
+    "Комната", "комнаты", "КОМНАТУ",
+    "дом 5", "дом1234", "дом",
+    "acd", "abcd", "abbcd", "abbbcd", "ACD",
+    "этаж", "этаж 3", "ЭТАЖ 3",
+    "продам квартиру", "квартиру продам",
+    "рядом метро", "метро рядом",
+    "ст. м. Пушкинская", "ст м пушкинская", "наст м пушкинская",
+    "2-комн", "4-комн",
+    "мебель", "без мебели", "без мебель",
+    "студия", "Студия у метро",
+    "STRASSE", "straße", "ss",
+    "",
+]
+
+
+@pytest.mark.parametrize("text", _TEXTS)
+def test_pruned_regex_matching(text: str) -> None:
+    index = _index({filter_: [i] for i, filter_ in enumerate(_REGEX_FILTERS)})
+
+    expected = set()
+    for i, filter_ in enumerate(_REGEX_FILTERS):
+        try:
+            if re.search(filter_, text, flags=re.IGNORECASE):
+                expected.add(UserId(i))
+        except re.error:
+            pass
+    assert index.match_text(text) == expected
@@ -0,0 +1,168 @@
+"""PostgreSQL paths of crud queries: upserts, INSERT ... RETURNING and COPY
+
+    TEST_POSTGRESQL_URL=postgresql+asyncpg://postgres@localhost/tg_filtering_bot_test python -m pytest tests
+
+The database is migrated to the latest revision and its tables are emptied before every test.
+"""
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, List
+
+import pytest
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool
+
+from tests.benchmark import _migrate
+from tg_filtering_bot.config import settings
+from tg_filtering_bot.crud import crud
+from tg_filtering_bot.crud.db import Base, ChatUser, CounterName, User, UserMessage
+from tg_filtering_bot.crud.dto import IngestStatus, QueueMessageDTO, UserChatDTO
+from tg_filtering_bot.crud.schema import ChatId, MessageId, UserId
+
+URL = os.environ.get("TEST_POSTGRESQL_URL")
+pytestmark = pytest.mark.skipif(URL is None, reason="TEST_POSTGRESQL_URL is not set")
+
+Run = Callable[[Callable[[], Awaitable[None]]], None]
+
+# Telegram ids above 32 bits
+USER_ID = UserId(6_000_000_001)
+CHANNEL_ID = ChatId(-1_001_234_567_890)
+
+
+@pytest.fixture
+def run(monkeypatch: pytest.MonkeyPatch) -> Run:
+    assert URL is not None
+    monkeypatch.setattr(settings, "SQLALCHEMY_DATABASE_URI", URL)
+    _migrate()
+
+    # Every test runs its own event loop, pooled connections would belong to the previous one
+    engine = create_async_engine(URL, poolclass=NullPool)
+    monkeypatch.setattr(crud, "engine", engine)
+    monkeypatch.setattr(crud, "async_session", async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession))
+    crud._user_chat_cache.clear()
+
+    tables = ", ".join(f'"{table.name}"' for table in Base.metadata.sorted_tables)
+
+    def run_test(test: Callable[[], Awaitable[None]]) -> None:
+        async def wrapped() -> None:
+            async with engine.begin() as conn:
+                await conn.execute(text(f"TRUNCATE {tables} RESTART IDENTITY CASCADE"))
+            await test()
+
+        asyncio.run(wrapped())
+
+    return run_test
+
+
+def _user_chat(user_id: UserId, chat_id: ChatId, name: str = "name") -> UserChatDTO:
+    return UserChatDTO(user_id=user_id, chat_id=chat_id, name=name, username="username", language_code="ru")
+
+
+def _message(message_id: int, message: str = "text") -> QueueMessageDTO:
+    return QueueMessageDTO(
+        message_id=MessageId(message_id), channel_id=CHANNEL_ID, message=message, date=datetime.now(timezone.utc)
+    )
+
+
+async def _all(query: Any) -> List[Any]:
+    async with crud.async_session() as session:
+        return list((await session.execute(query)).all())
+
+
+def test_create_or_update_user_chat(run: Run) -> None:
+    async def test() -> None:
+        await crud.create_or_update_user_chat(_user_chat(USER_ID, ChatId(USER_ID)))
+        assert await crud.get_counter(CounterName.USER_CHATS) == 1
+        assert await _all(select(ChatUser.chat_id, ChatUser.user_id)) == [(USER_ID, USER_ID)]
+
+        # Nothing changed, nothing is written
+        await crud.create_or_update_user_chat(_user_chat(USER_ID, ChatId(USER_ID)))
+        assert await crud.get_counter(CounterName.USER_CHATS) == 1
+
+        await crud.create_or_update_user_chat(_user_chat(USER_ID, ChatId(USER_ID), name="renamed"))
+        assert await _all(select(User.name)) == [("renamed",)]
+        assert await crud.get_counter(CounterName.USER_CHATS) == 1
+
+        # The chat belongs to another user now
+        other = UserId(USER_ID + 1)
+        await crud.create_or_update_user_chat(_user_chat(other, ChatId(USER_ID)))
+        assert await _all(select(ChatUser.chat_id, ChatUser.user_id)) == [(USER_ID, other)]
+        assert await crud.get_counter(CounterName.USER_CHATS) == 2
+
+    run(test)
+
+
+def test_add_messages_returning(run: Run) -> None:
+    async def test() -> None:
+        first_id = 10_000_000_000
+        assert await crud.add_messages_to_db([_message(first_id), _message(first_id + 1)]) == {
+            first_id, first_id + 1
+        }
+        assert await crud.add_messages_to_db([_message(first_id + 1), _message(first_id + 2)]) == {first_id + 2}
+
+        assert await crud.add_message_to_db(_message(first_id)) == IngestStatus.DUPLICATE
+        assert await crud.add_message_to_db(_message(first_id, "edited")) == IngestStatus.EDITED
+        assert await crud.add_message_to_db(_message(first_id + 3)) == IngestStatus.ADDED
+
+        # An edit in the same batch as the message itself
+        assert await crud.add_or_update_messages(
+            [_message(first_id + 4), _message(first_id + 4, "edited"), _message(first_id + 3), _message(first_id)]
+        ) == [IngestStatus.ADDED, IngestStatus.EDITED, IngestStatus.DUPLICATE, IngestStatus.EDITED]
+
+    run(test)
+
+
+def test_create_user_messages_copy(run: Run, monkeypatch: pytest.MonkeyPatch) -> None:
+    copied = []
+
+    async def copy_rows(*args: Any) -> None:
+        copied.append(len(args[2]))
+        await original_copy_rows(*args)
+
+    original_copy_rows = crud._copy_rows
+    monkeypatch.setattr(crud, "_copy_rows", copy_rows)
+    monkeypatch.setattr(settings, "DB_COPY_MIN_ROWS", 3)
+    user_ids = [UserId(USER_ID + i) for i in range(5)]
+
+    async def test() -> None:
+        for user_id in user_ids:
+            await crud.create_or_update_user_chat(_user_chat(user_id, ChatId(user_id)))
+        message = _message(10_000_000_000)
+        await crud.add_message_to_db(message)
+
+        await crud.create_user_messages(message.message_id, user_ids[:2])
+        await crud.create_user_messages(message.message_id, user_ids[2:])
+        assert copied == [3]
+
+        # Users added by a concurrent fan-out of an edit are skipped on both paths
+        await crud.create_user_messages(message.message_id, user_ids[:1])
+        await crud.create_user_messages(message.message_id, user_ids)
+        assert copied == [3, 5]
+
+        rows = await _all(select(UserMessage.user_id, UserMessage.processed).order_by(UserMessage.user_id))
+        assert rows == [(user_id, False) for user_id in user_ids]
+
+    run(test)
+
+
+def test_pending_user_messages_pages(run: Run) -> None:
+    user_ids = [UserId(USER_ID + i) for i in range(5)]
+
+    async def test() -> None:
+        for user_id in user_ids:
+            await crud.create_or_update_user_chat(_user_chat(user_id, ChatId(user_id)))
+        message = _message(10_000_000_000)
+        await crud.add_message_to_db(message)
+        await crud.create_user_messages(message.message_id, user_ids)
+
+        created_before = datetime.now(timezone.utc) + timedelta(minutes=1)
+        page = await crud.get_pending_user_messages(created_before, limit=2)
+        rest = await crud.get_pending_user_messages(created_before, limit=10, after=page[-1])
+        assert [p.user_id for p in page + rest] == user_ids
+
+        assert await crud.expire_user_messages(created_before) == 5
+        assert await crud.get_pending_user_messages(created_before, limit=10) == []
+
+    run(test)
@@ -0,0 +1,33 @@
+import pytest
+
+from tg_filtering_bot.crud.query_log import normalize_statement
+
+
+@pytest.mark.parametrize("statement, expected", [
+    (
+        "SELECT user.id FROM user WHERE user.id IN (?, ?, ?)",
+        "SELECT user.id FROM user WHERE user.id IN (...)"
+    ),
+    (
+        "INSERT INTO message (message_id, message) VALUES (?, ?), (?, ?),\n (?, ?) ON CONFLICT DO NOTHING",
+        "INSERT INTO message (message_id, message) VALUES (...) ON CONFLICT DO NOTHING"
+    ),
+    (
+        "INSERT INTO message (message_id, date) VALUES ($1::BIGINT, $2::TIMESTAMP WITH TIME ZONE), "
+        "($3::BIGINT, $4::TIMESTAMP WITH TIME ZONE) RETURNING message.message_id",
+        "INSERT INTO message (message_id, date) VALUES (...) RETURNING message.message_id"
+    ),
+    (
+        "SELECT pattern.id FROM pattern WHERE pattern.id IN (%(id_1)s, %(id_2)s) AND (pattern.id, 2) > (1, 2)",
+        "SELECT pattern.id FROM pattern WHERE pattern.id IN (...) AND (pattern.id, 2) > (1, 2)"
+    ),
+])
+def test_normalize_statement(statement: str, expected: str) -> None:
+    assert normalize_statement(statement) == expected
+
+
+def test_bulk_inserts_of_any_size_are_one_statement() -> None:
+    rows = ", ".join(f"(${i * 2 + 1}::BIGINT, ${i * 2 + 2}::VARCHAR(255))" for i in range(3))
+    assert normalize_statement(f"INSERT INTO t (a, b) VALUES {rows}") == normalize_statement(
+        "INSERT INTO t (a, b) VALUES ($1::BIGINT, $2::VARCHAR(255))"
+    )
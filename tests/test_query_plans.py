@@ -0,0 +1,9 @@
+from tests.benchmark import check_query_plans
+
+
+def test_no_full_scans() -> None:
+    [result] = check_query_plans(users=100)
+
+    assert result["metrics"]["statements"] > 0
+    full_scans = {plan["statement"]: plan["full_scans"] for plan in result["plans"] if plan["full_scans"]}
+    assert full_scans == {}
@@ -1,41 +1,163 @@
+import asyncio
+import threading
+import time
+from collections import deque
 from queue import Queue, Full, Empty
-from typing import Generic, TypeVar
-from asyncio import sleep
+from typing import Any, Deque, Dict, Generic, Iterable, List, Optional, TypeVar, Union
 
 
 T = TypeVar('T')
 
 
+class QueueBatch(Generic[T]):
+    """Several items sent through the underlying queue as a single pickled object"""
+
+    __slots__ = ("items",)
+
+    def __init__(self, items: List[T]) -> None:
+        self.items = items
+
+    def __getstate__(self) -> List[T]:
+        return self.items
+
+    def __setstate__(self, state: List[T]) -> None:
+        self.items = state
+
+
 class AsyncQueue(Generic[T]):
-    """Async wrapper for queue.Queue"""
+    """Async wrapper for queue.Queue
 
-    SLEEP: float = 0.01
+    Items are read by a dedicated thread blocked on the underlying queue
+    and handed over to the event loop with call_soon_threadsafe,
+    so idle consumers never wake up and new items are delivered immediately.
+    """
 
-    def __init__(self, queue: Queue[T]) -> None:
-        self._Q: Queue[T] = queue
+    def __init__(self, queue: Queue[Union[T, QueueBatch[T]]]) -> None:
+        self._Q: Queue[Union[T, QueueBatch[T]]] = queue
 
-    def get_nowait(self) -> T:
-        return self._Q.get_nowait()
+        self._reader: Optional[threading.Thread] = None
+        self._handover: Optional[asyncio.Queue[Union[T, QueueBatch[T]]]] = None
+        # The reader takes the next item only after the previous one was consumed,
+        # so the bounded underlying queue still applies backpressure to producers
+        self._slot = threading.Semaphore(1)
+        self._buffer: Deque[T] = deque()
+        self._put_lock: Optional[asyncio.Lock] = None
 
-    async def get(self) -> T:
+    def __getstate__(self) -> Dict[str, Any]:
+        return {"_Q": self._Q}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__init__(state["_Q"])  # type: ignore[misc]
+
+    def _read(self, loop: asyncio.AbstractEventLoop, handover: asyncio.Queue[Union[T, QueueBatch[T]]]) -> None:
         while True:
+            self._slot.acquire()
+            item = self._Q.get()
+            try:
+                loop.call_soon_threadsafe(handover.put_nowait, item)
+            except RuntimeError:
+                # Event loop is closed
+                return None
+
+    def _start_reader(self) -> asyncio.Queue[Union[T, QueueBatch[T]]]:
+        if self._handover is None:
+            self._handover = asyncio.Queue()
+            self._reader = threading.Thread(
+                target=self._read,
+                args=(asyncio.get_running_loop(), self._handover),
+                name="AsyncQueueReader",
+                daemon=True
+            )
+            self._reader.start()
+        return self._handover
+
+    def _unpack(self, item: Union[T, QueueBatch[T]]) -> None:
+        if isinstance(item, QueueBatch):
+            self._buffer.extend(item.items)
+        else:
+            self._buffer.append(item)
+
+    def _fill_nowait(self) -> bool:
+        if self._handover is None:
             try:
-                return self.get_nowait()
+                self._unpack(self._Q.get_nowait())
             except Empty:
-                await sleep(self.SLEEP)
+                return False
+            return True
+
+        try:
+            item = self._handover.get_nowait()
+        except asyncio.QueueEmpty:
+            return False
+        self._slot.release()
+        self._unpack(item)
+        return True
+
+    def get_nowait(self) -> T:
+        while not self._buffer:
+            if not self._fill_nowait():
+                raise Empty
+        return self._buffer.popleft()
+
+    async def get(self) -> T:
+        handover = self._start_reader()
+        while not self._buffer:
+            item = await handover.get()
+            self._slot.release()
+            self._unpack(item)
+        return self._buffer.popleft()
+
+    async def get_batch(self, max_items: int, max_wait: float = 0.0) -> List[T]:
+        """Waits for at least one item, then collects up to max_items
+        that arrive within max_wait seconds"""
+        batch = [await self.get()]
+        deadline = time.monotonic() + max_wait
+        handover = self._start_reader()
+
+        while len(batch) < max_items:
+            while self._buffer and len(batch) < max_items:
+                batch.append(self._buffer.popleft())
+            if len(batch) >= max_items or self._fill_nowait():
+                continue
+
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+
+            getter = asyncio.ensure_future(handover.get())
+            done, _ = await asyncio.wait({getter}, timeout=timeout)
+            if not done:
+                getter.cancel()
+                break
+            self._slot.release()
+            self._unpack(getter.result())
+
+        return batch
 
     async def put(self, item: T) -> None:
-        while True:
+        await self._put(item)
+
+    async def put_many(self, items: Iterable[T]) -> None:
+        """Sends items through the underlying queue as one batch"""
+        batch = list(items)
+        if batch:
+            await self._put(QueueBatch(batch))
+
+    async def _put(self, item: Union[T, QueueBatch[T]]) -> None:
+        if self._put_lock is None:
+            self._put_lock = asyncio.Lock()
+
+        # Keeps items in order while a blocking put waits for free space
+        async with self._put_lock:
             try:
                 self._Q.put_nowait(item)
-                return None
             except Full:
-                await sleep(self.SLEEP)
+                await asyncio.get_running_loop().run_in_executor(None, self._Q.put, item)
 
     def task_done(self) -> None:
         self._Q.task_done()
         return None
 
     @property
-    def sync_queue(self) -> Queue[T]:
+    def sync_queue(self) -> Queue[Union[T, QueueBatch[T]]]:
         return self._Q
@@ -0,0 +1,171 @@
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional
+
+from aiogram.utils.exceptions import RetryAfter
+
+from tg_filtering_bot.crud.dto import ForwardMessageDTO
+from tg_filtering_bot.crud.schema import ChatId
+from tg_filtering_bot.logger import get_logger
+from tg_filtering_bot.metrics import METRICS
+
+DELIVERY_RETRIES = METRICS.counter("delivery_retries_total", "Deliveries retried after flood control errors")
+PENDING_DELIVERIES = METRICS.gauge("pending_deliveries", "Messages waiting in the delivery scheduler")
+
+
+class TokenBucket:
+    """Rate limiter allowing `rate` operations per second with bursts up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None) -> None:
+        self._rate = rate
+        self._capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def delay(self) -> float:
+        """Seconds to wait before a token is available"""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+
+        self._refill(now)
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self._rate
+
+    def is_idle(self) -> bool:
+        return self.delay() == 0.0 and self._tokens >= self._capacity
+
+    def pause(self, seconds: float) -> None:
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + seconds)
+        self._tokens = 0.0
+        self._updated = max(now, self._paused_until)
+
+    async def acquire(self) -> None:
+        while True:
+            delay = self.delay()
+            if delay <= 0:
+                self._tokens -= 1
+                return None
+            await asyncio.sleep(delay)
+
+
+class DeliveryScheduler:
+    """Sends messages with a bounded pool of concurrent workers.
+
+    Messages for the same chat are sent one by one in the order they were submitted,
+    different chats are served concurrently within global and per-chat rate limits.
+    `send` is told whether it makes the last attempt, after which flood control errors are not retried.
+    """
+
+    LOGGER = get_logger("DeliveryScheduler")
+
+    def __init__(
+        self,
+        send: Callable[[ForwardMessageDTO, bool], Awaitable[None]],
+        workers: int,
+        global_rate: float,
+        chat_rate: float,
+        max_retries: int,
+        max_pending: int
+    ) -> None:
+        self._send = send
+        self._workers = workers
+        self._chat_rate = chat_rate
+        self._max_retries = max_retries
+        self._max_pending = max_pending
+
+        self._global_bucket = TokenBucket(global_rate)
+        self._chat_buckets: Dict[ChatId, TokenBucket] = {}
+        # Pending messages per chat, a chat is in the ready queue or being served while it has any
+        self._chats: Dict[ChatId, Deque[ForwardMessageDTO]] = {}
+        self._ready: Optional[asyncio.Queue[ChatId]] = None
+        self._pending: Optional[asyncio.Semaphore] = None
+        self._pending_count = 0
+        self._tasks: List[asyncio.Task] = []
+
+    def _init(self) -> asyncio.Queue[ChatId]:
+        if self._ready is None:
+            self._ready = asyncio.Queue()
+            self._pending = asyncio.Semaphore(self._max_pending)
+        return self._ready
+
+    def start(self) -> None:
+        self._init()
+        for _ in range(self._workers - len(self._tasks)):
+            self._tasks.append(asyncio.ensure_future(self._worker()))
+
+    async def submit(self, message: ForwardMessageDTO) -> None:
+        """Schedules the message, waits while too many messages are pending"""
+        ready = self._init()
+        assert self._pending is not None
+        await self._pending.acquire()
+        self._pending_count += 1
+        PENDING_DELIVERIES.set(self._pending_count)
+
+        chat_id = message.user_chat.chat_id
+        pending = self._chats.get(chat_id)
+        if pending is None:
+            self._chats[chat_id] = deque([message])
+            ready.put_nowait(chat_id)
+        else:
+            pending.append(message)
+
+    async def _worker(self) -> None:
+        ready = self._init()
+        assert self._pending is not None
+
+        while True:
+            chat_id = await ready.get()
+            pending = self._chats[chat_id]
+            try:
+                await self._deliver(chat_id, pending[0])
+            except Exception as e:
+                self.LOGGER.exception(e)
+            finally:
+                pending.popleft()
+                self._pending.release()
+                self._pending_count -= 1
+                PENDING_DELIVERIES.set(self._pending_count)
+
+            if pending:
+                # Other chats waiting in the ready queue are served first
+                ready.put_nowait(chat_id)
+            else:
+                del self._chats[chat_id]
+                bucket = self._chat_buckets.get(chat_id)
+                if bucket is not None and bucket.is_idle():
+                    del self._chat_buckets[chat_id]
+
+    async def _deliver(self, chat_id: ChatId, message: ForwardMessageDTO) -> None:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self._chat_rate)
+
+        for attempt in range(self._max_retries + 1):
+            last_attempt = attempt == self._max_retries
+            await bucket.acquire()
+            await self._global_bucket.acquire()
+            try:
+                return await self._send(message, last_attempt)
+            except RetryAfter as e:
+                # Flood waits apply to the whole bot, other chats would only get more of them
+                bucket.pause(e.timeout)
+                self._global_bucket.pause(e.timeout)
+                if last_attempt:
+                    self.LOGGER.error(
+                        "Giving up sending message %s to chat %s after %s retries",
+                        message.message.message_id, chat_id, self._max_retries
+                    )
+                    raise
+                self.LOGGER.warning(
+                    "Flood control for chat %s, retry in %s seconds, attempt %s", chat_id, e.timeout, attempt
+                )
+                DELIVERY_RETRIES.inc()
@@ -0,0 +1,191 @@
+"""Local stand-in for the Telegram Bot API, for load testing the bot without network access
+
+    python -m tg_filtering_bot.bot.fake_api --port 8081 --retry-after-share 0.01 --missing-chat-share 0.05
+    BOT_API_SERVER=http://127.0.0.1:8081 poetry run filtering_bot
+    curl http://127.0.0.1:8081/stats
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import zlib
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Optional, TextIO
+
+from aiohttp import web
+
+from tg_filtering_bot.logger import get_logger
+
+Handler = Callable[[str, Dict[str, Any]], Awaitable[web.Response]]
+
+
+def _ok(result: Any) -> web.Response:
+    return web.json_response({"ok": True, "result": result})
+
+
+def _error(status: int, description: str, **parameters: Any) -> web.Response:
+    body: Dict[str, Any] = {"ok": False, "error_code": status, "description": description}
+    if parameters:
+        body["parameters"] = parameters
+    return web.json_response(body, status=status)
+
+
+class FakeBotAPI:
+    """Accepts the Bot API methods used by FilteringBot and records deliveries.
+
+    A `missing_chat_share` of chats is not found, chats are picked by a hash of the chat id,
+    so the same chats fail every time. A `retry_after_share` of random deliveries fails
+    with flood control errors asking to retry after `retry_after` seconds.
+    """
+
+    LOGGER = get_logger("FakeBotAPI")
+
+    def __init__(
+        self,
+        retry_after_share: float = 0.0,
+        retry_after: int = 1,
+        missing_chat_share: float = 0.0,
+        latency: float = 0.0,
+        record: Optional[TextIO] = None,
+        seed: int = 0
+    ) -> None:
+        self._retry_after_share = retry_after_share
+        self._retry_after = retry_after
+        self._missing_chat_share = missing_chat_share
+        self._latency = latency
+        self._record = record
+        self._random = random.Random(seed)
+
+        self._message_id = 0
+        self._last_forwarded: Dict[str, int] = {}
+        self._stats: Dict[str, Any] = {
+            "forwarded": 0,
+            "sent": 0,
+            "retry_after": 0,
+            "chat_not_found": 0,
+            # Messages forwarded to a chat after a later channel message
+            "out_of_order": 0,
+            "chats": 0,
+            "first_delivery": None,
+            "last_delivery": None,
+        }
+
+        self._methods: Dict[str, Handler] = {
+            "getme": self._get_me,
+            "getupdates": self._get_updates,
+            "forwardmessage": self._forward_message,
+            "sendmessage": self._send_message,
+        }
+
+    def _is_missing(self, chat_id: str) -> bool:
+        return zlib.crc32(chat_id.encode()) % 10_000 < self._missing_chat_share * 10_000
+
+    def _message(self, chat_id: str) -> Dict[str, Any]:
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+        }
+
+    async def _deliver(self, kind: str, params: Dict[str, Any]) -> web.Response:
+        if self._latency:
+            await asyncio.sleep(self._latency)
+
+        chat_id = str(params["chat_id"])
+        if self._is_missing(chat_id):
+            self._stats["chat_not_found"] += 1
+            return _error(400, "Bad Request: chat not found")
+        if self._random.random() < self._retry_after_share:
+            self._stats["retry_after"] += 1
+            return _error(
+                429, f"Too Many Requests: retry after {self._retry_after}", retry_after=self._retry_after
+            )
+
+        now = time.time()
+        self._stats[kind] += 1
+        self._stats["first_delivery"] = self._stats["first_delivery"] or now
+        self._stats["last_delivery"] = now
+        if self._record is not None:
+            self._record.write(json.dumps({"time": now, "method": kind, **params}, ensure_ascii=False) + "\n")
+        return _ok(self._message(chat_id))
+
+    async def _get_me(self, token: str, params: Dict[str, Any]) -> web.Response:
+        return _ok({"id": int(token.split(":")[0]), "is_bot": True, "first_name": "Fake", "username": "fake_bot"})
+
+    async def _get_updates(self, token: str, params: Dict[str, Any]) -> web.Response:
+        # Nobody talks to the fake bot, long polling just waits
+        await asyncio.sleep(float(params.get("timeout", 0)))
+        return _ok([])
+
+    async def _forward_message(self, token: str, params: Dict[str, Any]) -> web.Response:
+        response = await self._deliver("forwarded", params)
+        if response.status == 200:
+            chat_id, message_id = str(params["chat_id"]), int(params["message_id"])
+            last = self._last_forwarded.get(chat_id)
+            if last is None:
+                self._stats["chats"] += 1
+            elif message_id < last:
+                self._stats["out_of_order"] += 1
+            self._last_forwarded[chat_id] = max(message_id, last or message_id)
+        return response
+
+    async def _send_message(self, token: str, params: Dict[str, Any]) -> web.Response:
+        return await self._deliver("sent", params)
+
+    async def _other(self, token: str, params: Dict[str, Any]) -> web.Response:
+        # setMyCommands, deleteWebhook and other calls that only need to succeed
+        return _ok(True)
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        params: Dict[str, Any] = dict(request.query)
+        if request.can_read_body:
+            params.update(await request.post())
+
+        method = request.match_info["method"].lower()
+        handler = self._methods.get(method, self._other)
+        return await handler(request.match_info["token"], params)
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        stats = dict(self._stats)
+        if stats["first_delivery"] and stats["last_delivery"] > stats["first_delivery"]:
+            delivered = stats["forwarded"] + stats["sent"]
+            stats["deliveries_per_second"] = delivered / (stats["last_delivery"] - stats["first_delivery"])
+        return web.json_response(stats)
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle_method)
+        app.router.add_get("/stats", self.handle_stats)
+        return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--retry-after-share", type=float, default=0.0, help="Part of deliveries failing with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Seconds to wait after a 429 error")
+    parser.add_argument("--missing-chat-share", type=float, default=0.0, help="Part of chats that are not found")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds every delivery takes")
+    parser.add_argument("--record", type=Path, help="File to write every delivery to as a JSON line")
+    args = parser.parse_args()
+
+    record = open(args.record, "a", encoding="utf-8") if args.record else None
+    api = FakeBotAPI(
+        retry_after_share=args.retry_after_share,
+        retry_after=args.retry_after,
+        missing_chat_share=args.missing_chat_share,
+        latency=args.latency,
+        record=record
+    )
+    try:
+        web.run_app(api.create_app(), host=args.host, port=args.port)
+    finally:
+        if record is not None:
+            record.close()
+
+
+if __name__ == "__main__":
+    main()
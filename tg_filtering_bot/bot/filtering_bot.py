@@ -3,20 +3,24 @@ import atexit
 import dataclasses
 import multiprocessing
 import time
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional, Tuple
 
 
 from aiogram import Bot, Dispatcher
+from aiogram.bot.api import TELEGRAM_PRODUCTION, TelegramAPIServer
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters import Text
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.types import BotCommand, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery, Message
 from aiogram.utils import executor
-from aiogram.utils.exceptions import MessageToForwardNotFound, ChatNotFound
+from aiogram.utils.exceptions import (
+    MessageToForwardNotFound, ChatNotFound, BotBlocked, UserDeactivated, CantInitiateConversation, RetryAfter
+)
 from aiogram.contrib.middlewares.i18n import I18nMiddleware
 
 from tg_filtering_bot.async_queue import AsyncQueue
+from tg_filtering_bot.bot.delivery import DeliveryScheduler
 from tg_filtering_bot.config import settings
 from tg_filtering_bot.crud.crud import (
     create_or_update_user_chat,
@@ -24,8 +28,12 @@ from tg_filtering_bot.crud.crud import (
     get_user_filters,
     disable_filter
 )
-from tg_filtering_bot.crud.dto import UserFilterDTO, UserChatDTO, ForwardMessageDTO
+from tg_filtering_bot.crud.dto import (
+    UserFilterDTO, UserChatDTO, ForwardMessageDTO, DeliveryAckDTO, DeliveryStatus
+)
 from tg_filtering_bot.logger import get_logger
+from tg_filtering_bot.metrics import METRICS, Snapshot, start_metrics_push
+from tg_filtering_bot.regex_safety import validate_filter, InvalidFilterError
 
 
 I18N = I18nMiddleware(settings.I18N_DOMAIN, settings.LOCALES_DIR)
@@ -55,18 +63,44 @@ def build_delete_filters_markup(
     return inline_kb
 
 
+DELIVERIES = METRICS.counter("deliveries_total", "Delivery attempts by status")
+FORWARD_SECONDS = METRICS.histogram("forward_seconds", "Time to forward a message to a user")
+
+
 class FilteringBot:
     LOGGER = get_logger("FilteringBot")
     _BTN_DELETE_PREFIX = "delete_"
-
-    def __init__(self, message_queue: AsyncQueue) -> None:
+    # Retrying deliveries failed with these errors makes no sense
+    _UNDELIVERABLE_ERRORS = (ChatNotFound, BotBlocked, UserDeactivated, CantInitiateConversation)
+
+    def __init__(
+        self,
+        message_queue: AsyncQueue,
+        ack_queue: AsyncQueue,
+        metrics_queue: Optional["multiprocessing.Queue[Tuple[str, Snapshot]]"] = None
+    ) -> None:
         self._message_queue = message_queue
+        self._ack_queue = ack_queue
+        self._metrics_queue = metrics_queue
+        self._acks: List[DeliveryAckDTO] = []
 
         self.storage = MemoryStorage()
-        self.bot = Bot(settings.BOT_TOKEN)
+        server = TELEGRAM_PRODUCTION
+        if settings.BOT_API_SERVER:
+            server = TelegramAPIServer.from_base(settings.BOT_API_SERVER)
+        self.bot = Bot(settings.BOT_TOKEN, server=server)
         self.dispatcher = Dispatcher(self.bot, storage=self.storage)
         self.dispatcher.middleware.setup(I18N)
 
+        self.delivery = DeliveryScheduler(
+            send=self.deliver_message,
+            workers=settings.BOT_DELIVERY_WORKERS,
+            global_rate=settings.BOT_GLOBAL_RATE,
+            chat_rate=settings.BOT_CHAT_RATE,
+            max_retries=settings.BOT_DELIVERY_RETRIES,
+            max_pending=settings.BOT_MAX_PENDING_DELIVERIES
+        )
+
         self.LOGGER.info("Bot created")
 
         self.dispatcher.register_message_handler(
@@ -143,25 +177,48 @@ class FilteringBot:
             )
             await create_or_update_user_chat(user_chat_dto)
 
-    async def _process_message_queue(self) -> None:
-        message = await self._message_queue.get()
+    async def _process_message(self, message: Any) -> None:
         if isinstance(message, ForwardMessageDTO):
-            return await self.forward_message(message)
+            return await self.delivery.submit(message)
 
         raise NotImplementedError(f"Processing for {message} is not implemented")
 
+    async def _process_message_queue(self) -> None:
+        messages = await self._message_queue.get_batch(settings.QUEUE_MAX_BATCH, settings.QUEUE_BATCH_LINGER)
+        for message in messages:
+            try:
+                await self._process_message(message)
+            except Exception as e:
+                self.LOGGER.exception(e)
+
     async def _periodic(self) -> None:
+        self.delivery.start()
         while True:
             try:
                 await self._process_message_queue()
             except Exception as e:
                 self.LOGGER.exception(e)
 
+    async def _flush_acks_periodic(self) -> None:
+        while True:
+            await asyncio.sleep(settings.BOT_ACK_FLUSH_INTERVAL)
+            acks, self._acks = self._acks, []
+            try:
+                await self._ack_queue.put_many(acks)
+            except Exception as e:
+                self.LOGGER.exception(e)
+                # Sent again with the next flush, the service handles repeated acks
+                self._acks[:0] = acks
+
     def start_bot(self) -> None:
+        if self._metrics_queue is not None:
+            start_metrics_push(self._metrics_queue, "bot", settings.METRICS_PUSH_INTERVAL)
+
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
         loop.create_task(self._set_base_commands())
         loop.create_task(self._periodic())
+        loop.create_task(self._flush_acks_periodic())
         executor.start_polling(self.dispatcher, loop=loop)
 
     def stop_bot(self) -> None:
@@ -237,6 +294,18 @@ Please use command {command} to add a new address.""").format(
         address = message.text
         self.LOGGER.info("Adding new address: %s", message)
 
+        try:
+            await asyncio.get_event_loop().run_in_executor(
+                None, validate_filter, address, settings.FILTER_MAX_LENGTH, settings.FILTER_VALIDATION_TIMEOUT
+            )
+        except InvalidFilterError as e:
+            self.LOGGER.warning("Rejected address %r: %s", address, e)
+            await self.bot.send_message(
+                message.chat.id,
+                _("Filter '{address}' cannot be used, please type another street name").format(address=address)
+            )
+            return None
+
         user_filter = UserFilterDTO(user_id=message.from_user.id, filter_=address, filter_id=-1)
         await add_filter(user_filter)
 
@@ -280,24 +349,62 @@ Please use command {command} to add a new address.""").format(
         )
 
         try:
-            await self.bot.forward_message(
-                forward_message.user_chat.chat_id,
-                from_chat_id=forward_message.message.channel_id,
-                message_id=forward_message.message.message_id
-            )
+            with FORWARD_SECONDS.time():
+                await self.bot.forward_message(
+                    forward_message.user_chat.chat_id,
+                    from_chat_id=forward_message.message.channel_id,
+                    message_id=forward_message.message.message_id
+                )
         except (MessageToForwardNotFound, ChatNotFound):
             self.LOGGER.warning(
                 "Cannot forward message %s", forward_message.message.message_id
             )
             return await self.send_message_to_user(forward_message)
 
+    def _ack(self, forward_message: ForwardMessageDTO, status: DeliveryStatus) -> None:
+        DELIVERIES.inc(status=status.value)
+        self._acks.append(DeliveryAckDTO(
+            user_id=forward_message.user_chat.user_id,
+            message_id=forward_message.message.message_id,
+            status=status,
+            latency=time.time() - forward_message.enqueued_at
+        ))
+
+    async def deliver_message(self, forward_message: ForwardMessageDTO, last_attempt: bool) -> None:
+        try:
+            await self.forward_message(forward_message)
+        except RetryAfter:
+            # Retried by the delivery scheduler until it gives up
+            if last_attempt:
+                self._ack(forward_message, DeliveryStatus.FAILED)
+            raise
+        except self._UNDELIVERABLE_ERRORS as e:
+            self.LOGGER.warning(
+                "Cannot deliver message %s to user %s: %s",
+                forward_message.message.message_id, forward_message.user_chat.user_id, e
+            )
+            return self._ack(forward_message, DeliveryStatus.UNDELIVERABLE)
+        except Exception:
+            self._ack(forward_message, DeliveryStatus.FAILED)
+            raise
+
+        self._ack(forward_message, DeliveryStatus.SENT)
 
-def start_filtering_bot() -> AsyncQueue[ForwardMessageDTO]:
+
+def start_filtering_bot(
+    metrics_queue: Optional["multiprocessing.Queue[Tuple[str, Snapshot]]"] = None
+) -> Tuple[AsyncQueue[ForwardMessageDTO], AsyncQueue[DeliveryAckDTO]]:
     queue: multiprocessing.Queue[ForwardMessageDTO] = multiprocessing.Queue(maxsize=settings.QUEUE_SIZE)
     message_queue = AsyncQueue(queue)
 
+    acks: multiprocessing.Queue[DeliveryAckDTO] = multiprocessing.Queue(maxsize=settings.QUEUE_SIZE)
+    # A multiprocessing queue provides the queue.Queue methods used by AsyncQueue
+    ack_queue: AsyncQueue[DeliveryAckDTO] = AsyncQueue(acks)  # type: ignore[arg-type]
+
     bot = FilteringBot(
-        message_queue=message_queue
+        message_queue=message_queue,
+        ack_queue=ack_queue,
+        metrics_queue=metrics_queue
     )
 
     process = multiprocessing.Process(target=bot.start_bot)
@@ -309,4 +416,4 @@ def start_filtering_bot() -> AsyncQueue[ForwardMessageDTO]:
     if process.exitcode is not None:
         raise RuntimeError("FilteringBot closed after launch")
 
-    return message_queue
+    return message_queue, ack_queue
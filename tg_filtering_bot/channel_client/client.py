@@ -1,15 +1,29 @@
+import asyncio
 import atexit
 import multiprocessing
 import time
-from typing import Any
+from typing import Any, Optional, Tuple
 
 from telethon import TelegramClient, events
 
 from tg_filtering_bot.async_queue import AsyncQueue
+from tg_filtering_bot.channel_client.sources import MessageSource, create_source
 from tg_filtering_bot.config import settings
 from tg_filtering_bot.crud.dto import QueueMessageDTO
 from tg_filtering_bot.crud.schema import ChatId
 from tg_filtering_bot.logger import get_logger
+from tg_filtering_bot.metrics import METRICS, Snapshot, start_metrics_push
+
+CHANNEL_MESSAGES = METRICS.counter("channel_messages_total", "Channel messages read by the monitoring client")
+
+
+def to_queue_message(message: Any) -> QueueMessageDTO:
+    return QueueMessageDTO(
+        message_id=message.id,
+        channel_id=ChatId(message.chat_id),
+        message=str(message.message),
+        date=message.date
+    )
 
 
 class MonitoringClient:
@@ -24,26 +38,50 @@ class MonitoringClient:
             settings.LISTENER_API_NAME, settings.LISTENER_API_ID, settings.LISTENER_API_HASH
         )
 
-    def __init__(self, message_queue: AsyncQueue) -> None:
-        self.client = self.create_client()
-
-        self.client.add_event_handler(
-            self.event_handler,
-            events.NewMessage(chats=settings.LISTENER_CHANNEL_ID)
-        )
+    def __init__(
+        self,
+        message_queue: AsyncQueue,
+        metrics_queue: Optional["multiprocessing.Queue[Tuple[str, Snapshot]]"] = None,
+        source: Optional[MessageSource] = None
+    ) -> None:
+        self.source = source
+        self.client: Optional[TelegramClient] = None
+        if source is None:
+            self.client = self.create_client()
+            self.client.add_event_handler(
+                self.event_handler,
+                events.NewMessage(chats=settings.LISTENER_CHANNEL_ID)
+            )
+            # Edited posts are queued as well, the service notifies users they match now
+            self.client.add_event_handler(
+                self.edit_handler,
+                events.MessageEdited(chats=settings.LISTENER_CHANNEL_ID)
+            )
 
         self.queue = message_queue
+        self._metrics_queue = metrics_queue
 
     async def load_old_messages(self, limit: int) -> None:
+        assert self.client is not None
+        batch = []
         async for message in self.client.iter_messages(entity=settings.LISTENER_CHANNEL_ID, limit=limit):
-            await self.queue.put(QueueMessageDTO(
-                message_id=message.id,
-                channel_id=ChatId(message.chat_id),
-                message=str(message.message),
-                date=message.date
-            ))
+            batch.append(to_queue_message(message))
+            if len(batch) >= settings.QUEUE_MAX_BATCH:
+                await self.queue.put_many(batch)
+                CHANNEL_MESSAGES.inc(len(batch), source="history")
+                batch = []
+
+        await self.queue.put_many(batch)
+        CHANNEL_MESSAGES.inc(len(batch), source="history")
 
     def start(self) -> None:
+        if self._metrics_queue is not None:
+            start_metrics_push(self._metrics_queue, "client", settings.METRICS_PUSH_INTERVAL)
+
+        if self.source is not None:
+            return asyncio.run(self.read_source(self.source))
+
+        assert self.client is not None
         self.client.start(phone=settings.LISTENER_PHONE, password=settings.LISTENER_PASSWORD)
         self.LOGGER.info("Client Started")
 
@@ -58,15 +96,26 @@ class MonitoringClient:
             except Exception as e:
                 self.LOGGER.exception(e)
 
+    async def read_source(self, source: MessageSource) -> None:
+        self.LOGGER.info("Reading %s messages", source.NAME)
+        async for batch in source.batches(settings.QUEUE_MAX_BATCH):
+            await self.queue.put_many(batch)
+            CHANNEL_MESSAGES.inc(len(batch), source=source.NAME)
+        self.LOGGER.info("No more %s messages", source.NAME)
+        # Like a channel without new posts, the process keeps running until it is stopped
+        await asyncio.Event().wait()
+
     async def event_handler(self, event: Any) -> None:
         self.LOGGER.info("Event %s", event)
 
-        await self.queue.put(QueueMessageDTO(
-            message_id=event.id,
-            channel_id=ChatId(event.message.chat_id),
-            message=str(event.message.message),
-            date=event.date
-        ))
+        await self.queue.put(to_queue_message(event.message))
+        CHANNEL_MESSAGES.inc(source="live")
+
+    async def edit_handler(self, event: Any) -> None:
+        self.LOGGER.info("Edit event %s", event)
+
+        await self.queue.put(to_queue_message(event.message))
+        CHANNEL_MESSAGES.inc(source="edited")
 
     @classmethod
     def login(cls) -> None:
@@ -79,10 +128,12 @@ class MonitoringClient:
         )
 
 
-def start_monitoring_process() -> AsyncQueue[QueueMessageDTO]:
+def start_monitoring_process(
+    metrics_queue: Optional["multiprocessing.Queue[Tuple[str, Snapshot]]"] = None
+) -> AsyncQueue[QueueMessageDTO]:
     queue: multiprocessing.Queue[QueueMessageDTO] = multiprocessing.Queue(maxsize=settings.QUEUE_SIZE)
     async_queue = AsyncQueue(queue)
-    monitoring_client = MonitoringClient(async_queue)
+    monitoring_client = MonitoringClient(async_queue, metrics_queue, source=create_source())
 
     process = multiprocessing.Process(target=monitoring_client.start)
     process.start()
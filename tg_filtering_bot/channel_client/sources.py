@@ -0,0 +1,91 @@
+import abc
+import asyncio
+import itertools
+import json
+import random
+import time
+from pathlib import Path
+from typing import AsyncIterator, Iterable, Iterator, List, Optional
+
+from tg_filtering_bot.config import settings
+from tg_filtering_bot.crud.dto import QueueMessageDTO
+from tg_filtering_bot.synthetic import SEED, iter_messages, message_from_json
+
+
+class MessageSource(abc.ABC):
+    """Channel messages read by MonitoringClient instead of Telegram, for load testing"""
+
+    NAME = ""
+
+    def __init__(self, rate: float) -> None:
+        # Messages per second, 0 to read them as fast as the queue takes them
+        self._rate = rate
+
+    @abc.abstractmethod
+    def _messages(self) -> Iterable[QueueMessageDTO]:
+        pass
+
+    async def batches(self, max_items: int) -> AsyncIterator[List[QueueMessageDTO]]:
+        messages = iter(self._messages())
+        started = time.monotonic()
+        sent = 0
+
+        while True:
+            count = max_items
+            if self._rate > 0:
+                elapsed = time.monotonic() - started
+                count = min(max_items, int(elapsed * self._rate) - sent)
+                if count <= 0:
+                    await asyncio.sleep((sent + 1) / self._rate - elapsed)
+                    continue
+
+            batch = list(itertools.islice(messages, count))
+            if not batch:
+                return
+            sent += len(batch)
+            yield batch
+
+
+class SyntheticSource(MessageSource):
+    NAME = "synthetic"
+
+    def __init__(self, rate: float, count: int, seed: int = SEED) -> None:
+        super().__init__(rate)
+        self._count = count
+        self._seed = seed
+
+    def _messages(self) -> Iterator[QueueMessageDTO]:
+        # Ids of earlier runs are already in the database
+        messages = iter_messages(random.Random(self._seed), first_id=int(time.time() * 1000))
+        if self._count > 0:
+            return itertools.islice(messages, self._count)
+        return messages
+
+
+class ReplaySource(MessageSource):
+    """Messages from a file with a JSON object per line, as written by `python -m tg_filtering_bot.synthetic`"""
+
+    NAME = "replay"
+
+    def __init__(self, rate: float, path: Path) -> None:
+        super().__init__(rate)
+        self._path = path
+
+    def _messages(self) -> Iterator[QueueMessageDTO]:
+        with open(self._path, encoding="utf-8") as replay:
+            for line in replay:
+                if line.strip():
+                    yield message_from_json(json.loads(line))
+
+
+def create_source() -> Optional[MessageSource]:
+    """Source configured by LISTENER_SOURCE, None for the Telegram channel"""
+    if settings.LISTENER_SOURCE == "telegram":
+        return None
+    if settings.LISTENER_SOURCE == SyntheticSource.NAME:
+        return SyntheticSource(settings.LISTENER_SOURCE_RATE, settings.LISTENER_SYNTHETIC_COUNT)
+    if settings.LISTENER_SOURCE == ReplaySource.NAME:
+        if settings.LISTENER_REPLAY_FILE is None:
+            raise ValueError("LISTENER_REPLAY_FILE is required to replay messages")
+        return ReplaySource(settings.LISTENER_SOURCE_RATE, settings.LISTENER_REPLAY_FILE)
+    raise ValueError(f"Unknown message source {settings.LISTENER_SOURCE}")
@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import Union
+from typing import Optional, Union
 
 from pydantic import BaseSettings
 
@@ -23,12 +23,97 @@ class Settings(BaseSettings):
     LISTENER_CHANNEL_ID: Union[str, int]
     LISTENER_CHANNEL_NAME: str = ""  # Optional
     LISTENER_LOAD_PREV_MESSAGES: int = 10
+    # Read messages from "telegram", or for load testing from a "synthetic" generator or a "replay" file,
+    # at LISTENER_SOURCE_RATE messages per second, 0 for as fast as the service takes them
+    LISTENER_SOURCE: str = "telegram"
+    LISTENER_SOURCE_RATE: float = 100
+    # Number of synthetic messages, 0 for no limit
+    LISTENER_SYNTHETIC_COUNT: int = 0
+    LISTENER_REPLAY_FILE: Optional[Path] = None
 
     BOT_TOKEN: str
+    # Bot API server URL, e.g. http://127.0.0.1:8081 for `python -m tg_filtering_bot.bot.fake_api`, empty for Telegram
+    BOT_API_SERVER: str = ""
+    # Delivery limits, Telegram allows about 30 messages per second overall and 1 per second per chat
+    BOT_DELIVERY_WORKERS: int = 16
+    BOT_GLOBAL_RATE: float = 30
+    BOT_CHAT_RATE: float = 1
+    BOT_DELIVERY_RETRIES: int = 5
+    BOT_MAX_PENDING_DELIVERIES: int = 4096
+    # How often delivery acknowledgements are sent back to the service, seconds
+    BOT_ACK_FLUSH_INTERVAL: float = 0.5
 
     SQLALCHEMY_DATABASE_URI: str = "sqlite+aiosqlite:///" + str(BASE_DIR.parent / "tg_filtering_bot.db")
+    # Log every statement with its parameters, too verbose for production
+    DB_ECHO: bool = False
+    # Structured query log, all off by default: share of statements logged, statements slower than the threshold
+    # in seconds, and how often the statements with the largest total time are logged, seconds
+    DB_QUERY_LOG_SAMPLE_RATE: float = 0.0
+    DB_SLOW_QUERY_THRESHOLD: float = 0.0
+    DB_QUERY_STATS_INTERVAL: float = 0.0
+    # Connections kept per process for PostgreSQL, the service pipeline, outbox and caches use up to about 8 at once
+    DB_POOL_SIZE: int = 8
+    DB_MAX_OVERFLOW: int = 8
+    # PostgreSQL loads user messages of a channel message with COPY when there are at least this many recipients
+    DB_COPY_MIN_ROWS: int = 64
+    # SQLite performance profile: WAL lets the bot read while the service writes,
+    # NORMAL sync may lose the last transactions on power loss but never corrupts the database in WAL mode,
+    # memory mapped I/O size in bytes, page cache size in KiB if negative, lock wait time in milliseconds.
+    # The page cache is private to every connection, so it is multiplied by the connections of all processes,
+    # the memory map is shared. SQLite serializes writers, so its pool is smaller than DB_POOL_SIZE
+    SQLITE_JOURNAL_MODE: str = "WAL"
+    SQLITE_SYNCHRONOUS: str = "NORMAL"
+    SQLITE_MMAP_SIZE: int = 256 * 1024 * 1024
+    SQLITE_CACHE_SIZE: int = -8 * 1024
+    SQLITE_BUSY_TIMEOUT: int = 5000
+    SQLITE_POOL_SIZE: int = 4
+    SQLITE_MAX_OVERFLOW: int = 4
+
+    # Limits for user supplied filters: length, time to match adversarial input when the filter is added
+    # and time to match a message, a filter exceeding it FILTER_MAX_STRIKES times is quarantined, seconds
+    FILTER_MAX_LENGTH: int = 200
+    FILTER_VALIDATION_TIMEOUT: float = 1.0
+    FILTER_MATCH_TIME_BUDGET: float = 0.05
+    FILTER_MAX_STRIKES: int = 3
+    # Number of processes sharing the filter index, 0 to match filters in the service process
+    MATCHER_PROCESSES: int = 0
+
+    # Prometheus text endpoint served by the main process, 0 to disable,
+    # metrics can also be dumped to the log every METRICS_DUMP_INTERVAL seconds
+    METRICS_HOST: str = "127.0.0.1"
+    METRICS_PORT: int = 0
+    METRICS_DUMP_INTERVAL: float = 0
+    # How often child processes send their metrics to the main process, seconds
+    METRICS_PUSH_INTERVAL: float = 5
 
     QUEUE_SIZE = 1024
+    # Cache of recipients' latest chats, how often it checks whether cached chats changed, seconds
+    USER_CHAT_CACHE_SIZE: int = 100_000
+    USER_CHAT_CACHE_TTL: float = 3600
+    USER_CHAT_CACHE_CHECK_INTERVAL: float = 1.0
+
+    # Concurrency of MainService pipeline stages
+    SERVICE_PERSIST_WORKERS: int = 2
+    SERVICE_FAN_OUT_WORKERS: int = 2
+    SERVICE_STAGE_QUEUE_SIZE: int = 64
+    SERVICE_STATS_INTERVAL: float = 60
+    # Recently processed channel messages, replays of them are skipped before any database query, seconds
+    SERVICE_RECENT_MESSAGES: int = 10_000
+    SERVICE_RECENT_MESSAGES_TTL: float = 24 * 3600
+
+    # Unsent user messages older than the grace period are enqueued again every interval, seconds
+    OUTBOX_INTERVAL: float = 60
+    OUTBOX_GRACE_PERIOD: float = 300
+    OUTBOX_PAGE_SIZE: int = 500
+    # Unsent user messages older than this are given up on, e.g. after repeated send failures, seconds
+    OUTBOX_MAX_AGE: float = 24 * 3600
+    # Messages enqueued for the bot are not redelivered until they are acknowledged or the lease expires, seconds
+    OUTBOX_LEASE: float = 3600
+    # Max number of items taken from a queue per wakeup and how long to wait for the batch to fill, seconds
+    QUEUE_MAX_BATCH: int = 256
+    QUEUE_BATCH_LINGER: float = 0.0
+    # How often the service checks whether cached active filters are outdated, seconds
+    FILTERS_CACHE_CHECK_INTERVAL: float = 1.0
     DEBUG: bool = False
 
     I18N_DOMAIN = "FilteringBot"
@@ -0,0 +1,69 @@
+import time
+from collections import OrderedDict
+from typing import Generic, Hashable, Iterable, Optional, Tuple, TypeVar
+
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+class TTLCache(Generic[K, V]):
+    """LRU cache whose entries also expire `ttl` seconds after they were set"""
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._data: OrderedDict[K, Tuple[float, V]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: K) -> bool:
+        return self.lookup(key)[0]
+
+    def lookup(self, key: K) -> Tuple[bool, Optional[V]]:
+        """Returns (found, value), so that None values can be cached too"""
+        entry = self._data.get(key)
+        if entry is None:
+            return False, None
+
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            return False, None
+
+        self._data.move_to_end(key)
+        return True, value
+
+    def set(self, key: K, value: V) -> None:
+        self._data[key] = (time.monotonic() + self._ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, keys: Iterable[K]) -> None:
+        for key in keys:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+
+class VersionedTTLCache(TTLCache[K, V]):
+    """TTLCache cleared when the version of the cached data changes,
+    the version is expected to be checked at most every `check_interval` seconds"""
+
+    def __init__(self, maxsize: int, ttl: float, check_interval: float) -> None:
+        super().__init__(maxsize, ttl)
+        self._check_interval = check_interval
+        self._checked_at = float("-inf")
+        self._version: Optional[int] = None
+
+    def is_check_due(self) -> bool:
+        return time.monotonic() - self._checked_at >= self._check_interval
+
+    def set_version(self, version: int) -> None:
+        self._checked_at = time.monotonic()
+        if version != self._version:
+            self.clear()
+            self._version = version
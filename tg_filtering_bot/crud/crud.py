@@ -1,113 +1,448 @@
-from typing import List, Optional
+import datetime
+import typing
+from typing import Any, List, Optional, Iterable, Dict, Collection, Iterator, Sequence, Set, TypeVar, Union
+
+from sqlalchemy import select, update, func, tuple_, false, literal, or_, cast, String, column, table, text
+from sqlalchemy.engine import CursorResult, Result
+from sqlalchemy.sql.elements import ColumnElement
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from tg_filtering_bot.config import settings
+from tg_filtering_bot.crud.cache import VersionedTTLCache
+from tg_filtering_bot.crud.db import (
+    Message, async_session, engine, User, Status, ChatUser, Filter, Pattern, UserMessage, ChangeCounter, CounterName
+)
+from tg_filtering_bot.crud.dto import (
+    QueueMessageDTO, UserChatDTO, UserFilterDTO, PatternDTO, PendingUserMessageDTO, IngestStatus, user_id_array
+)
+from tg_filtering_bot.crud.schema import UserId, MessageId
 
-from sqlalchemy import select, update
 
-from tg_filtering_bot.crud.db import Message, async_session, User, Status, ChatUser, Filter, UserMessage
-from tg_filtering_bot.crud.dto import QueueMessageDTO, UserChatDTO, UserFilterDTO
-from tg_filtering_bot.crud.schema import UserId, MessageId
+T = TypeVar('T')
+
+_user_chat_cache: VersionedTTLCache[UserId, Optional[UserChatDTO]] = VersionedTTLCache(
+    maxsize=settings.USER_CHAT_CACHE_SIZE,
+    ttl=settings.USER_CHAT_CACHE_TTL,
+    check_interval=settings.USER_CHAT_CACHE_CHECK_INTERVAL
+)
+
+# Keeps the number of bound parameters of IN clauses below the SQLite limit
+CHUNK_SIZE = 500
+
+
+def _chunks(items: Iterable[T], size: int = CHUNK_SIZE) -> Iterator[List[T]]:
+    chunk: List[T] = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _insert(model: Any) -> Union[postgresql.Insert, sqlite.Insert]:
+    """INSERT supporting ON CONFLICT clauses of the configured database"""
+    if engine.dialect.name == "postgresql":
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+
+def _aggregate_ids(column: Any) -> ColumnElement:
+    """Comma separated ids of a group, to read one row per group"""
+    if engine.dialect.name == "postgresql":
+        return func.string_agg(cast(column, String), ",")
+    return func.group_concat(column, ",")
+
+
+def _rowcount(result: Result[Any]) -> int:
+    """Number of rows matched by an UPDATE, the typed result of a session does not expose it"""
+    return typing.cast(CursorResult[Any], result).rowcount
+
+
+async def _copy_rows(session: AsyncSession, model: Any, rows: List[Dict[str, Any]]) -> None:
+    """Bulk load with PostgreSQL COPY through asyncpg, rows that are already in the table are skipped.
 
+    COPY itself can not skip conflicting rows, so they are copied into a temporary table,
+    emptied on commit, and inserted from it with ON CONFLICT DO NOTHING.
+    """
+    staging = f"{model.__tablename__}_copy"
+    await session.execute(text(
+        f'CREATE TEMPORARY TABLE IF NOT EXISTS "{staging}" '
+        f'(LIKE "{model.__tablename__}" INCLUDING DEFAULTS) ON COMMIT DELETE ROWS'
+    ))
 
-async def add_message_to_db(queue_message: QueueMessageDTO) -> Message:
-    db_message = Message(
-        message_id=queue_message.message_id,
-        channel_id=queue_message.channel_id,
-        message=queue_message.message,
-        date=queue_message.date
+    connection = await session.connection()
+    raw_connection = await connection.get_raw_connection()
+    driver_connection = raw_connection.driver_connection
+    assert driver_connection is not None
+    columns = list(rows[0])
+    await driver_connection.copy_records_to_table(
+        staging,
+        records=[tuple(row[column] for column in columns) for row in rows],
+        columns=columns
     )
+
+    staged = table(staging, *(column(name) for name in columns))
+    await session.execute(
+        postgresql.insert(model).from_select(columns, select(*staged.c)).on_conflict_do_nothing()
+    )
+
+
+async def _bump_counter(session: AsyncSession, name: CounterName) -> None:
+    query = update(ChangeCounter).where(
+        ChangeCounter.name == name
+    ).values(
+        value=ChangeCounter.value + 1
+    )
+    result = await session.execute(query)
+    if _rowcount(result) == 0:
+        session.add(ChangeCounter(name=name, value=1))
+
+
+async def get_counter(name: CounterName) -> int:
+    query = select(ChangeCounter.value).filter(ChangeCounter.name == name)
+
     async with async_session() as session:
-        session.add(db_message)
+        value = (await session.execute(query)).scalar()
+        return value or 0
+
+
+async def add_message_to_db(queue_message: QueueMessageDTO) -> IngestStatus:
+    """Adds a new message or updates the text of an edited one, replayed messages are left as they are"""
+    [status] = await add_or_update_messages([queue_message])
+    return status
+
+
+async def add_or_update_messages(queue_messages: Sequence[QueueMessageDTO]) -> List[IngestStatus]:
+    """Adds new messages with one insert and updates the text of edited ones,
+    returns statuses in the order of the messages"""
+    added = await add_messages_to_db(queue_messages)
+
+    statuses: List[IngestStatus] = []
+    for queue_message in queue_messages:
+        if queue_message.message_id in added:
+            # A later message with the same id in the batch is an edit of this one
+            added.discard(queue_message.message_id)
+            statuses.append(IngestStatus.ADDED)
+        else:
+            statuses.append(IngestStatus.DUPLICATE)
+
+    known = [i for i, status in enumerate(statuses) if status == IngestStatus.DUPLICATE]
+    if not known:
+        return statuses
+
+    async with async_session() as session:
+        for i in known:
+            query = update(Message).where(
+                Message.message_id == queue_messages[i].message_id
+            ).where(
+                Message.message.is_distinct_from(queue_messages[i].message)
+            ).values(
+                message=queue_messages[i].message
+            ).execution_options(
+                # Nothing is loaded in the new session, IS DISTINCT FROM can not be evaluated in Python anyway
+                synchronize_session=False
+            )
+            if _rowcount(await session.execute(query)) > 0:
+                statuses[i] = IngestStatus.EDITED
         await session.commit()
 
-    return db_message
+    return statuses
+
 
+async def add_messages_to_db(queue_messages: Collection[QueueMessageDTO]) -> Set[MessageId]:
+    """Adds messages missing in the database, returns ids of the added ones"""
+    if not queue_messages:
+        return set()
 
-async def create_user_message(
-    user_id: UserId, message_id: MessageId, processed: bool = False
-) -> UserMessage:
-    db_user_message = UserMessage(
-        user_id=user_id,
-        message_id=message_id,
-        processed=processed
+    rows = [
+        dict(message_id=m.message_id, channel_id=m.channel_id, message=m.message, date=m.date)
+        for m in queue_messages
+    ]
+    query = _insert(Message).on_conflict_do_nothing(
+        index_elements=[Message.message_id]
+    ).returning(
+        Message.message_id
     )
+    async with async_session() as session:
+        added = set(map(MessageId, (await session.scalars(query, rows)).all()))
+        await session.commit()
+
+    return added
+
+
+async def create_user_messages(
+    message_id: MessageId, user_ids: Collection[UserId], processed: bool = False
+) -> None:
+    if not user_ids:
+        return None
+
+    # Set explicitly, so stored dates have the same format as the keyset bounds of get_pending_user_messages
+    date = datetime.datetime.now(datetime.timezone.utc)
+    rows = [
+        dict(user_id=user_id, message_id=message_id, processed=processed, date=date)
+        for user_id in user_ids
+    ]
+    # An edit of the message may be fanned out concurrently and add some of the same users first
+    async with async_session() as session:
+        if engine.dialect.name == "postgresql" and len(rows) >= settings.DB_COPY_MIN_ROWS:
+            await _copy_rows(session, UserMessage, rows)
+        else:
+            query = _insert(UserMessage).on_conflict_do_nothing(
+                index_elements=[UserMessage.user_id, UserMessage.message_id]
+            )
+            await session.execute(query, rows)
+        await session.commit()
 
+
+async def create_missing_user_messages(
+    message_id: MessageId, user_ids: Collection[UserId], processed: bool = False
+) -> Set[UserId]:
+    """Creates the message for users who do not have it yet, returns those users"""
+    if not user_ids:
+        return set()
+
+    date = datetime.datetime.now(datetime.timezone.utc)
+    rows = [
+        dict(user_id=user_id, message_id=message_id, processed=processed, date=date)
+        for user_id in user_ids
+    ]
+    query = _insert(UserMessage).on_conflict_do_nothing(
+        index_elements=[UserMessage.user_id, UserMessage.message_id]
+    ).returning(
+        UserMessage.user_id
+    )
     async with async_session() as session:
-        session.add(db_user_message)
+        created = set(map(UserId, (await session.scalars(query, rows)).all()))
         await session.commit()
 
-    return db_user_message
+    return created
 
 
-async def mark_user_message_as_processed(db_user_message: UserMessage) -> None:
+async def mark_user_messages_as_processed(message_id: MessageId, user_ids: Collection[UserId]) -> None:
+    if not user_ids:
+        return None
+
+    async with async_session() as session:
+        for chunk in _chunks(user_ids):
+            query = update(UserMessage).where(
+                UserMessage.message_id == message_id
+            ).where(
+                UserMessage.user_id.in_(chunk)
+            ).values(
+                processed=True
+            )
+            await session.execute(query)
+        await session.commit()
+
+
+async def expire_user_messages(created_before: datetime.datetime) -> int:
+    """Marks unprocessed user messages created before the date as processed, returns their number"""
+    query = update(UserMessage).where(
+        UserMessage.processed == false()
+    ).where(
+        UserMessage.date < created_before
+    ).values(
+        processed=True
+    )
     async with async_session() as session:
-        db_user_message.processed = True
-        session.add(db_user_message)
+        expired = _rowcount(await session.execute(query))
         await session.commit()
 
+    return expired
+
+
+async def get_pending_user_messages(
+    created_before: datetime.datetime,
+    limit: int,
+    after: Optional[PendingUserMessageDTO] = None
+) -> List[PendingUserMessageDTO]:
+    """Page of unprocessed user messages ordered by date, `after` is the last item of the previous page"""
+    query = select(
+        UserMessage.user_id,
+        UserMessage.date,
+        Message.message_id,
+        Message.channel_id,
+        Message.message,
+        Message.date.label("message_date")
+    ).select_from(
+        UserMessage
+    ).join(
+        Message, Message.message_id == UserMessage.message_id
+    ).filter(
+        UserMessage.processed == false()
+    ).filter(
+        UserMessage.date < created_before
+    ).order_by(
+        UserMessage.date.asc(), UserMessage.user_id.asc(), UserMessage.message_id.asc()
+    ).limit(
+        limit
+    )
+
+    if after is not None:
+        query = query.filter(
+            tuple_(UserMessage.date, UserMessage.user_id, UserMessage.message_id)
+            > tuple_(literal(after.date), literal(after.user_id), literal(after.message.message_id))
+        )
+
+    async with async_session() as session:
+        result = (await session.execute(query)).all()
+        return [
+            PendingUserMessageDTO(
+                user_id=r.user_id,
+                date=r.date,
+                message=QueueMessageDTO(
+                    message_id=r.message_id,
+                    channel_id=r.channel_id,
+                    message=r.message,
+                    date=r.message_date
+                )
+            )
+            for r in result
+        ]
+
 
 async def create_or_update_user_chat(user_chat: UserChatDTO) -> None:
-    db_user = User(
+    # Filters of a user who blocked the bot become active again
+    reactivate_user = update(User).where(
+        User.user_id == user_chat.user_id
+    ).where(
+        User.status != Status.ACTIVE
+    ).values(
+        status=Status.ACTIVE
+    )
+
+    upsert_user = _insert(User).values(
         user_id=user_chat.user_id,
         name=user_chat.name,
         username=user_chat.username,
         language_code=user_chat.language_code,
         status=Status.ACTIVE
     )
+    upsert_user = upsert_user.on_conflict_do_update(
+        index_elements=[User.user_id],
+        set_=dict(
+            name=upsert_user.excluded.name,
+            username=upsert_user.excluded.username,
+            language_code=upsert_user.excluded.language_code,
+            time_updated=func.now()
+        ),
+        where=or_(
+            User.name.is_distinct_from(upsert_user.excluded.name),
+            User.username.is_distinct_from(upsert_user.excluded.username),
+            User.language_code.is_distinct_from(upsert_user.excluded.language_code)
+        )
+    )
 
-    db_chat_user = ChatUser(
+    # Changes the row count only if the chat is new or belongs to another user now
+    upsert_chat = _insert(ChatUser).values(
         chat_id=user_chat.chat_id,
         user_id=user_chat.user_id
     )
+    upsert_chat = upsert_chat.on_conflict_do_update(
+        index_elements=[ChatUser.chat_id],
+        set_=dict(user_id=upsert_chat.excluded.user_id),
+        where=ChatUser.user_id != upsert_chat.excluded.user_id
+    )
 
     async with async_session() as session:
-        user_update = await session.merge(db_user)
-        session.add(user_update)
+        status_changed = _rowcount(await session.execute(reactivate_user)) > 0
+        if status_changed:
+            await _bump_counter(session, CounterName.FILTERS)
+        await session.execute(upsert_user)
 
-        chat_update = await session.merge(db_chat_user)
-        session.add(chat_update)
+        chat_changed = _rowcount(await session.execute(upsert_chat)) > 0
+        if status_changed or chat_changed:
+            await _bump_counter(session, CounterName.USER_CHATS)
 
         await session.commit()
 
+    _user_chat_cache.invalidate([user_chat.user_id])
+
+
+async def _check_user_chat_cache() -> None:
+    if _user_chat_cache.is_check_due():
+        _user_chat_cache.set_version(await get_counter(CounterName.USER_CHATS))
+
+
+async def get_latest_user_chats(user_ids: Collection[UserId]) -> Dict[UserId, UserChatDTO]:
+    result: Dict[UserId, UserChatDTO] = {}
+    if not user_ids:
+        return result
+
+    await _check_user_chat_cache()
+    missing = []
+    for user_id in user_ids:
+        found, user_chat = _user_chat_cache.lookup(user_id)
+        if not found:
+            missing.append(user_id)
+        elif user_chat is not None:
+            result[user_id] = user_chat
+
+    if not missing:
+        return result
 
-async def get_latest_user_chat(user_id: UserId) -> Optional[UserChatDTO]:
-    query = select(
-        ChatUser.user_id,
-        ChatUser.chat_id,
-        User.name,
-        User.username,
-        User.language_code
-    ).select_from(
-        ChatUser
-    ).join(
-        User, User.user_id == ChatUser.user_id
-    ).filter(
-        ChatUser.user_id == user_id
-    ).filter(
-        User.status == Status.ACTIVE
-    ).order_by(
-        ChatUser.time_created.desc()
-    )
     async with async_session() as session:
-        result = (await session.execute(query)).first()
-        if result:
-            return UserChatDTO(
-                user_id=result.user_id,
-                chat_id=result.chat_id,
-                name=result.name,
-                username=result.username,
-                language_code=result.language_code
+        for chunk in _chunks(missing):
+            ranked = select(
+                ChatUser.user_id,
+                ChatUser.chat_id,
+                func.row_number().over(
+                    partition_by=ChatUser.user_id,
+                    order_by=ChatUser.time_created.desc()
+                ).label("rank")
+            ).filter(
+                ChatUser.user_id.in_(chunk)
+            ).subquery()
+
+            query = select(
+                ranked.c.user_id,
+                ranked.c.chat_id,
+                User.name,
+                User.username,
+                User.language_code
+            ).select_from(
+                ranked
+            ).join(
+                User, User.user_id == ranked.c.user_id
+            ).filter(
+                ranked.c.rank == 1
+            ).filter(
+                User.status == Status.ACTIVE
             )
-    return None
 
+            for r in (await session.execute(query)).all():
+                result[r.user_id] = UserChatDTO(
+                    user_id=r.user_id,
+                    chat_id=r.chat_id,
+                    name=r.name,
+                    username=r.username,
+                    language_code=r.language_code
+                )
 
-async def add_filter(user_filter: UserFilterDTO) -> None:
-    db_filter = Filter(
+    for user_id in missing:
+        # Users without an active chat are cached too
+        _user_chat_cache.set(user_id, result.get(user_id))
+    return result
 
-        user_id=user_filter.user_id,
-        filter_=user_filter.filter_,
-        status=Status.ACTIVE
-    )
+
+async def _get_or_create_pattern(session: AsyncSession, pattern: str) -> int:
+    query = _insert(Pattern).values(pattern=pattern).on_conflict_do_nothing(index_elements=[Pattern.pattern])
+    await session.execute(query)
+    return (await session.execute(select(Pattern.pattern_id).filter(Pattern.pattern == pattern))).scalar_one()
+
+
+async def add_filter(user_filter: UserFilterDTO) -> None:
     async with async_session() as session:
+        db_filter = Filter(
+            user_id=user_filter.user_id,
+            pattern_id=await _get_or_create_pattern(session, user_filter.filter_),
+            status=Status.ACTIVE
+        )
         session.add(db_filter)
+        await _bump_counter(session, CounterName.FILTERS)
         await session.commit()
 
 
@@ -122,33 +457,48 @@ async def disable_filter(user_filter: UserFilterDTO) -> None:
 
     async with async_session() as session:
         await session.execute(query)
+        await _bump_counter(session, CounterName.FILTERS)
         await session.commit()
 
 
-async def get_active_filters() -> List[UserFilterDTO]:
+async def get_active_patterns() -> List[PatternDTO]:
+    """Patterns of active filters of active users, a row per pattern however many users share it"""
     query = select(
-        User.user_id, Filter.filter_, Filter.filter_id
+        Pattern.pattern_id, Pattern.pattern, _aggregate_ids(Filter.user_id).label("user_ids")
     ).select_from(
         Filter
     ).join(
         User, User.user_id == Filter.user_id
+    ).join(
+        Pattern, Pattern.pattern_id == Filter.pattern_id
     ).filter(
         User.status == Status.ACTIVE
     ).filter(
         Filter.status == Status.ACTIVE
+    ).group_by(
+        Pattern.pattern_id
     )
 
     async with async_session() as session:
         result = (await session.execute(query)).all()
 
-        return [UserFilterDTO(user_id=r.user_id, filter_=r.filter_, filter_id=r.filter_id) for r in result]
+        return [
+            PatternDTO(
+                pattern_id=r.pattern_id,
+                pattern=r.pattern,
+                user_ids=user_id_array(int(user_id) for user_id in r.user_ids.split(","))
+            )
+            for r in result
+        ]
 
 
 async def get_user_filters(user_id: UserId) -> List[UserFilterDTO]:
     query = select(
-        Filter.filter_id, Filter.filter_
+        Filter.filter_id, Pattern.pattern
     ).select_from(
         Filter
+    ).join(
+        Pattern, Pattern.pattern_id == Filter.pattern_id
     ).filter(
         Filter.status == Status.ACTIVE
     ).filter(
@@ -160,6 +510,6 @@ async def get_user_filters(user_id: UserId) -> List[UserFilterDTO]:
     async with async_session() as session:
         result = (await session.execute(query)).all()
         return [
-            UserFilterDTO(filter_id=r.filter_id, filter_=r.filter_, user_id=user_id)
+            UserFilterDTO(filter_id=r.filter_id, filter_=r.pattern, user_id=user_id)
             for r in result
         ]
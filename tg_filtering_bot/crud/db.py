@@ -1,14 +1,25 @@
 import enum
 import logging
+import time
+from typing import Any, Dict, Optional
 
-from sqlalchemy import Column, Integer, Enum, String, ForeignKey, DateTime, Boolean, func, PrimaryKeyConstraint
+from sqlalchemy import event, make_url
+from sqlalchemy import (
+    Column, Integer, BigInteger, Enum, String, ForeignKey, DateTime, Boolean, func, PrimaryKeyConstraint, Index, text
+)
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
-from sqlalchemy.orm import declarative_base
+from sqlalchemy.orm import Mapped, declarative_base
 
 from tg_filtering_bot.config import settings
+from tg_filtering_bot.crud.query_log import QueryLog
+from tg_filtering_bot.metrics import METRICS
 
 Base = declarative_base()
 
+# Telegram ids do not fit 32 bits, SQLite integers are 64 bit anyway and only INTEGER primary keys are rowids.
+# The mypy plugin can not infer the type of foreign keys of the variant, they are annotated
+TelegramId = BigInteger().with_variant(Integer(), "sqlite")
+
 
 class Status(str, enum.Enum):
     ACTIVE = "ACTIVE"
@@ -18,7 +29,7 @@ class Status(str, enum.Enum):
 class User(Base):
     __tablename__ = "user"
 
-    user_id = Column(Integer, primary_key=True)
+    user_id = Column(TelegramId, primary_key=True)
     name = Column(String, nullable=True)
     username = Column(String, nullable=True)
     language_code = Column(String, nullable=True)
@@ -31,8 +42,19 @@ class User(Base):
 class ChatUser(Base):
     __tablename__ = "chat_user"
 
-    chat_id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey("user.user_id"), nullable=False)
+    chat_id = Column(TelegramId, primary_key=True)
+    user_id: Mapped[int] = Column(TelegramId, ForeignKey("user.user_id"), nullable=False)
+    time_created = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    ix_user_id_time_created = Index("ix_chat_user_user_id_time_created", user_id, time_created)
+
+
+class Pattern(Base):
+    """Filter text stored once for all users having a filter with it"""
+    __tablename__ = "pattern"
+
+    # Annotated, the mypy plugin infers Optional[int] for a primary key
+    pattern_id: Mapped[int] = Column(Integer, primary_key=True, autoincrement=True)
+    pattern = Column(String, nullable=False, unique=True)
     time_created = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
 
 
@@ -40,36 +62,110 @@ class Filter(Base):
     __tablename__ = "filter"
 
     filter_id = Column(Integer, primary_key=True, autoincrement=True)
-    user_id = Column(Integer, ForeignKey("user.user_id"))
-    filter_ = Column(String, nullable=False)
+    user_id: Mapped[Optional[int]] = Column(TelegramId, ForeignKey("user.user_id"))
+    pattern_id = Column(Integer, ForeignKey("pattern.pattern_id"), nullable=False)
     status = Column(Enum(Status), nullable=False)
 
     time_created = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     time_updated = Column(DateTime(timezone=True), onupdate=func.now())
+    # Filters of a user in the order they were added
+    ix_user_id_status_time_created = Index("ix_filter_user_id_status_time_created", user_id, status, time_created)
+    # Users of every active pattern, read in pattern order without touching the table
+    ix_active_pattern_id_user_id = Index(
+        "ix_filter_active_pattern_id_user_id", pattern_id, user_id,
+        sqlite_where=text("status = 'ACTIVE'"), postgresql_where=text("status = 'ACTIVE'")
+    )
 
 
 class Message(Base):
     __tablename__ = "message"
 
-    message_id = Column(Integer, primary_key=True)
-    channel_id = Column(Integer, nullable=False)
+    message_id = Column(TelegramId, primary_key=True)
+    channel_id = Column(TelegramId, nullable=False)
     message = Column(String, nullable=True)
     date = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
 
 
+class CounterName(str, enum.Enum):
+    FILTERS = "FILTERS"
+    USER_CHATS = "USER_CHATS"
+
+
+class ChangeCounter(Base):
+    """Versions bumped on every change of the data cached by the service"""
+    __tablename__ = "change_counter"
+
+    name = Column(Enum(CounterName), primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
+
 class UserMessage(Base):
     __tablename__ = "user_message"
 
-    user_id = Column(Integer, ForeignKey("user.user_id"), nullable=False)
-    message_id = Column(Integer, ForeignKey("message.message_id"), nullable=False)
+    user_id: Mapped[int] = Column(TelegramId, ForeignKey("user.user_id"), nullable=False)
+    message_id: Mapped[int] = Column(TelegramId, ForeignKey("message.message_id"), nullable=False)
 
     date = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     processed = Column(Boolean, nullable=False)
     pk = PrimaryKeyConstraint(user_id, message_id)
+    ix_processed_date = Index("ix_user_message_processed_date", processed, date)
+
+
+def _engine_options() -> Dict[str, Any]:
+    url = make_url(settings.SQLALCHEMY_DATABASE_URI)
+    if url.get_backend_name() == "sqlite":
+        if url.database in (None, "", ":memory:"):
+            # In-memory databases use a single static connection
+            return {}
+        return {"pool_size": settings.SQLITE_POOL_SIZE, "max_overflow": settings.SQLITE_MAX_OVERFLOW}
+    return {"pool_size": settings.DB_POOL_SIZE, "max_overflow": settings.DB_MAX_OVERFLOW}
 
 
 logging.warning("Using database %s", settings.SQLALCHEMY_DATABASE_URI)
-engine = create_async_engine(settings.SQLALCHEMY_DATABASE_URI, echo=True)
+engine = create_async_engine(settings.SQLALCHEMY_DATABASE_URI, echo=settings.DB_ECHO, **_engine_options())
 async_session = async_sessionmaker(
     engine, expire_on_commit=False, class_=AsyncSession
 )
+
+DB_QUERY_SECONDS = METRICS.histogram("db_query_seconds", "Time of SQL statements execution")
+query_log = QueryLog(
+    sample_rate=settings.DB_QUERY_LOG_SAMPLE_RATE,
+    slow_threshold=settings.DB_SLOW_QUERY_THRESHOLD,
+    stats_interval=settings.DB_QUERY_STATS_INTERVAL
+)
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _before_cursor_execute(conn: Any, *args: Any) -> None:
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+@event.listens_for(engine.sync_engine, "after_cursor_execute")
+def _after_cursor_execute(
+    conn: Any, cursor: Any, statement: str, parameters: Any, context: Any, executemany: bool
+) -> None:
+    duration = time.perf_counter() - conn.info["query_started"].pop()
+    DB_QUERY_SECONDS.observe(duration)
+    query_log.record(statement, parameters, duration, executemany)
+
+
+@event.listens_for(engine.sync_engine, "handle_error")
+def _handle_error(context: Any) -> None:
+    started = context.connection.info.get("query_started") if context.connection is not None else None
+    if started:
+        started.pop()
+
+
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine.sync_engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection: Any, connection_record: Any) -> None:
+        cursor = dbapi_connection.cursor()
+        for pragma, value in (
+            ("journal_mode", settings.SQLITE_JOURNAL_MODE),
+            ("synchronous", settings.SQLITE_SYNCHRONOUS),
+            ("mmap_size", settings.SQLITE_MMAP_SIZE),
+            ("cache_size", settings.SQLITE_CACHE_SIZE),
+            ("busy_timeout", settings.SQLITE_BUSY_TIMEOUT),
+        ):
+            cursor.execute(f"PRAGMA {pragma} = {value}")
+        cursor.close()
@@ -1,11 +1,22 @@
 import dataclasses
 import datetime
+import enum
+from array import array
+from typing import Iterable
 
 from tg_filtering_bot.crud.schema import UserId, MessageId, ChatId
 
 
+def user_id_array(user_ids: Iterable[int]) -> "array[int]":
+    """Sorted unique user ids, 8 bytes per id instead of a set entry and an int object"""
+    return array("q", sorted(set(user_ids)))
+
+
+# DTOs define __slots__, there are as many of them as recipients or subscriptions,
+# dataclass(slots=True) needs Python 3.10 and __slots__ do not allow field defaults
 @dataclasses.dataclass
 class QueueMessageDTO:
+    __slots__ = ("message_id", "channel_id", "message", "date")
     message_id: MessageId
     channel_id: ChatId
     message: str
@@ -14,6 +25,7 @@ class QueueMessageDTO:
 
 @dataclasses.dataclass
 class UserChatDTO:
+    __slots__ = ("user_id", "chat_id", "name", "username", "language_code")
     user_id: UserId
     chat_id: ChatId
     name: str
@@ -23,12 +35,59 @@ class UserChatDTO:
 
 @dataclasses.dataclass
 class UserFilterDTO:
+    __slots__ = ("user_id", "filter_", "filter_id")
     user_id: UserId
     filter_: str
     filter_id: int
 
 
+@dataclasses.dataclass
+class PatternDTO:
+    """Filter text stored once, with all users having an active filter with it"""
+    __slots__ = ("pattern_id", "pattern", "user_ids")
+    pattern_id: int
+    pattern: str
+    # Built by user_id_array
+    user_ids: "array[int]"
+
+
+@dataclasses.dataclass
+class PendingUserMessageDTO:
+    __slots__ = ("user_id", "message", "date")
+    user_id: UserId
+    message: QueueMessageDTO
+    date: datetime.datetime
+
+
 @dataclasses.dataclass
 class ForwardMessageDTO:
+    __slots__ = ("message", "user_chat", "enqueued_at")
     message: QueueMessageDTO
     user_chat: UserChatDTO
+    # Wall clock time, comparable between processes
+    enqueued_at: float
+
+
+class IngestStatus(str, enum.Enum):
+    ADDED = "ADDED"
+    # The message is known and its text changed
+    EDITED = "EDITED"
+    # The same message with the same text is already in the database
+    DUPLICATE = "DUPLICATE"
+
+
+class DeliveryStatus(str, enum.Enum):
+    SENT = "SENT"
+    # Permanent error, e.g. the bot was blocked by the user
+    UNDELIVERABLE = "UNDELIVERABLE"
+    FAILED = "FAILED"
+
+
+@dataclasses.dataclass
+class DeliveryAckDTO:
+    __slots__ = ("user_id", "message_id", "status", "latency")
+    user_id: UserId
+    message_id: MessageId
+    status: DeliveryStatus
+    # Seconds between enqueueing the message in the service and the delivery attempt
+    latency: float
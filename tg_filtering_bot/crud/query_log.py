@@ -0,0 +1,96 @@
+import json
+import random
+import re
+import time
+from typing import Any, Dict, List
+
+from tg_filtering_bot.logger import get_logger
+
+# Expanded IN lists and VALUES of bulk inserts differ only in the number of placeholders and rows,
+# asyncpg placeholders are cast, e.g. $1::TIMESTAMP WITH TIME ZONE
+_PLACEHOLDER = r"\s*(?:\?|%s|%\(\w+\)s|\$\d+|:\w+)(?:::\w+(?: \w+)*(?:\([\d, ]*\))?(?:\[\])?)?\s*"
+_PLACEHOLDER_LISTS = re.compile(rf"\((?:{_PLACEHOLDER},)*{_PLACEHOLDER}\)")
+_ROW_LISTS = re.compile(r"\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+")
+_WHITESPACE = re.compile(r"\s+")
+_MAX_PARAMETERS_LENGTH = 200
+
+
+def normalize_statement(statement: str) -> str:
+    statement = _ROW_LISTS.sub("(...)", _PLACEHOLDER_LISTS.sub("(...)", statement))
+    return _WHITESPACE.sub(" ", statement).strip()
+
+
+class QueryLog:
+    """Structured logging of SQL statements: a random sample of them, the slow ones,
+    and periodically the statements with the largest total time, every record is a JSON object"""
+
+    LOGGER = get_logger("QueryLog")
+
+    def __init__(self, sample_rate: float, slow_threshold: float, stats_interval: float, stats_top: int = 10) -> None:
+        self._sample_rate = sample_rate
+        self._slow_threshold = slow_threshold
+        self._stats_interval = stats_interval
+        self._stats_top = stats_top
+
+        # {normalized statement: [count, total seconds, max seconds]}
+        self._stats: Dict[str, List[float]] = {}
+        self._stats_since = time.monotonic()
+
+    @property
+    def enabled(self) -> bool:
+        return self._sample_rate > 0 or self._slow_threshold > 0 or self._stats_interval > 0
+
+    def _log(self, event: str, **fields: Any) -> None:
+        self.LOGGER.info(json.dumps({"event": event, **fields}, ensure_ascii=False, default=str))
+
+    def record(self, statement: str, parameters: Any, duration: float, executemany: bool) -> None:
+        if not self.enabled:
+            return None
+
+        slow = 0 < self._slow_threshold <= duration
+        if slow or (self._sample_rate > 0 and random.random() < self._sample_rate):
+            self._log(
+                "slow_query" if slow else "query",
+                duration_ms=round(duration * 1000, 3),
+                statement=normalize_statement(statement),
+                parameters=repr(parameters)[:_MAX_PARAMETERS_LENGTH],
+                executemany=executemany
+            )
+
+        if self._stats_interval > 0:
+            self._aggregate(statement, duration)
+
+    def _aggregate(self, statement: str, duration: float) -> None:
+        key = normalize_statement(statement)
+        stats = self._stats.get(key)
+        if stats is None:
+            self._stats[key] = [1, duration, duration]
+        else:
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+
+        now = time.monotonic()
+        if now - self._stats_since >= self._stats_interval:
+            self.flush_stats(now)
+
+    def flush_stats(self, now: float) -> None:
+        top = sorted(self._stats.items(), key=lambda item: item[1][1], reverse=True)[:self._stats_top]
+        self._log(
+            "query_stats",
+            interval_s=round(now - self._stats_since, 3),
+            statements=len(self._stats),
+            queries=int(sum(stats[0] for stats in self._stats.values())),
+            top=[
+                {
+                    "statement": statement,
+                    "count": int(count),
+                    "total_ms": round(total * 1000, 3),
+                    "mean_ms": round(total / count * 1000, 3),
+                    "max_ms": round(max_ * 1000, 3),
+                }
+                for statement, (count, total, max_) in top
+            ]
+        )
+        self._stats = {}
+        self._stats_since = now
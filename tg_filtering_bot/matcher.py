@@ -1,38 +1,420 @@
 import dataclasses
+import functools
 import re
-from typing import List, Dict, Set
+import time
+import unicodedata
+from collections import deque
+from array import array
+from typing import List, Dict, Set, Iterable, Tuple, Optional, cast
 
-from tg_filtering_bot.crud.dto import UserFilterDTO, QueueMessageDTO
+from tg_filtering_bot.crud.dto import PatternDTO, UserFilterDTO, QueueMessageDTO, user_id_array
 from tg_filtering_bot.crud.schema import UserId
+from tg_filtering_bot.logger import get_logger
+
+try:
+    from re import _parser as sre_parse  # type: ignore[attr-defined]
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+
+# A dot stays a wildcard, saved filters like "3.5" match "3,5" as they always did
+_REGEX_SYNTAX = re.compile(r"[.^$*+?{}\[\]\\|()]")
+
+_TOKENS = re.compile(r"\d+|[^\W\d_]+")
+_CYRILLIC = re.compile(r"[а-яё]")
+# Latin letters looking like Cyrillic ones, after casefolding, e.g. "Ленинa" typed with a Latin "a"
+_HOMOGLYPHS = str.maketrans("abcehkmoptxy", "авсенкмортху")
+_TRANSLITERATION_UNITS = re.compile(r"shch|sch|zh|kh|ts|ch|sh|yu|ya|yo|ye|[a-z]")
+_TRANSLITERATION = {
+    "shch": "щ", "sch": "щ", "zh": "ж", "kh": "х", "ts": "ц", "ch": "ч", "sh": "ш",
+    "yu": "ю", "ya": "я", "yo": "е", "ye": "е",
+    "a": "а", "b": "б", "c": "ц", "d": "д", "e": "е", "f": "ф", "g": "г", "h": "х", "i": "и", "j": "й",
+    "k": "к", "l": "л", "m": "м", "n": "н", "o": "о", "p": "п", "q": "к", "r": "р", "s": "с", "t": "т",
+    "u": "у", "v": "в", "w": "в", "x": "кс", "z": "з",
+}
+_VOWELS = frozenset("aeiouy")
+# Letters that are often omitted or swapped: "ё" and "е", "й" and "и", "Октябрьская" and "Oktyabrskaya"
+_FOLDING = str.maketrans({"ё": "е", "й": "и", "э": "е", "ь": None, "ъ": None})
+_STREET_ABBREVIATIONS = {
+    "ул": "улица", "пр": "проспект", "просп": "проспект", "пер": "переулок", "пл": "площадь",
+    "бул": "бульвар", "ш": "шоссе", "наб": "набережная", "мкр": "микрорайон", "д": "дом", "стр": "строение",
+    "d": "дом", "st": "улица", "str": "строение", "street": "улица", "ul": "улица", "ulitsa": "улица",
+    "ave": "проспект", "avenue": "проспект", "pr": "проспект", "prospekt": "проспект",
+    "lane": "переулок", "per": "переулок", "pereulok": "переулок",
+}
+
+
+def _transliterate(token: str) -> str:
+    result = []
+    previous = ""
+    for unit in _TRANSLITERATION_UNITS.findall(token):
+        if unit == "y":
+            # "Pervomayskaya", "Gorkiy" but "Novyy"
+            result.append("й" if previous in _VOWELS else "ы")
+        else:
+            result.append(_TRANSLITERATION[unit])
+        previous = unit[-1]
+    return "".join(result)
+
+
+@functools.lru_cache(maxsize=65536)
+def _normalize_token(token: str) -> str:
+    if _CYRILLIC.search(token):
+        token = token.translate(_HOMOGLYPHS)
+    token = _STREET_ABBREVIATIONS.get(token, token)
+    if not token.isdigit():
+        token = _transliterate(token) if token.isascii() else _TRANSLITERATION_UNITS.sub(
+            lambda m: _transliterate(m.group()), token
+        )
+    return token.translate(_FOLDING)
+
+
+def normalize_text(text: str) -> str:
+    """Canonical form of an address text: Unicode compatibility forms, case, Cyrillic homoglyphs,
+    transliteration and street abbreviations are unified and punctuation is dropped,
+    e.g. "ул. Ленина, д.5" and "ulitsa Lenina dom 5" both become "улица ленина дом 5"
+    """
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return " ".join(_normalize_token(token) for token in _TOKENS.findall(text))
+
+
+def get_literal(filter_: str) -> Optional[str]:
+    """Returns the normalized filter text if it contains no regex syntax"""
+    if not filter_ or _REGEX_SYNTAX.search(filter_):
+        return None
+    return normalize_text(filter_) or None
+
+
+_REPEATS = {sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, "POSSESSIVE_REPEAT", None)}
+# Shorter literals are found in almost every message and do not narrow down candidates
+_MIN_REQUIRED_LENGTH = 2
+
+
+def _collect_required(items: Iterable[Tuple[int, object]], required: List[str]) -> None:
+    run: List[str] = []
+
+    def flush() -> None:
+        if len(run) >= _MIN_REQUIRED_LENGTH:
+            required.append("".join(run).casefold())
+        run.clear()
+
+    for op, av in items:
+        if op is sre_parse.LITERAL:
+            run.append(chr(av))  # type: ignore[arg-type]
+            continue
+        if op is sre_parse.AT:
+            # Anchors like \b do not consume characters, literals around them stay adjacent
+            continue
+
+        flush()
+        if op is sre_parse.SUBPATTERN:
+            _collect_required(av[-1], required)  # type: ignore[index]
+        elif op in _REPEATS and av[0] >= 1:  # type: ignore[index]
+            _collect_required(av[2], required)  # type: ignore[index]
+        elif op is getattr(sre_parse, "ATOMIC_GROUP", None):
+            _collect_required(av, required)  # type: ignore[arg-type]
+    flush()
+
+
+def required_literals(pattern: str) -> Tuple[str, ...]:
+    """Casefolded literals every match of the pattern contains, e.g. ("ленина", "12") for "ленина +(д.)?12".
+    Alternatives, character classes and optional parts are skipped, so the result may be empty.
+    """
+    try:
+        parsed = sre_parse.parse(pattern, flags=re.IGNORECASE)
+    except re.error:
+        return ()
+
+    required: List[str] = []
+    _collect_required(parsed, required)
+    return tuple(dict.fromkeys(required))
 
 
 @dataclasses.dataclass
 class FilterGroup:
-    regexp: re.Pattern
-    users: Set[UserId]
+    __slots__ = ("regexp", "users", "literal", "required", "strikes")
+    # None if the filter is not a valid regular expression
+    regexp: Optional[re.Pattern]
+    # Sorted user ids, shared with the PatternDTO
+    users: "array[int]"
+    # Normalized text of a plain-text filter
+    literal: Optional[str]
+    # Literals of a regular expression that a matching text has to contain
+    required: Tuple[str, ...]
+    # Number of searches that exceeded the time budget
+    strikes: int
 
 
-def _build_matchers(filters: List[UserFilterDTO]) -> List[FilterGroup]:
-    result: Dict[str, FilterGroup] = {}
+def _compile(filter_: str) -> Optional[re.Pattern]:
+    try:
+        return re.compile(filter_, flags=re.IGNORECASE)
+    except re.error:
+        return None
 
+
+def group_filters(filters: Iterable[UserFilterDTO]) -> List[PatternDTO]:
+    """Patterns of the given filters with their users, pattern ids are assigned in order of appearance"""
+    users: Dict[str, Set[UserId]] = {}
     for f in filters:
-        if f.filter_ in result:
-            result[f.filter_].users.add(f.user_id)
+        users.setdefault(f.filter_, set()).add(f.user_id)
+    return [
+        PatternDTO(pattern_id=pattern_id, pattern=pattern, user_ids=user_id_array(user_ids))
+        for pattern_id, (pattern, user_ids) in enumerate(users.items())
+    ]
+
+
+def diff_patterns(
+    current: Dict[int, PatternDTO], actual: Iterable[PatternDTO]
+) -> Tuple[List[PatternDTO], List[PatternDTO]]:
+    """Patterns to add or update and to remove to turn current patterns, keyed by pattern_id, into actual ones"""
+    actual_by_id = {p.pattern_id: p for p in actual}
+
+    removed = [p for pattern_id, p in current.items() if pattern_id not in actual_by_id]
+    added = [p for pattern_id, p in actual_by_id.items() if current.get(pattern_id) != p]
+    return added, removed
+
+
+class LiteralAutomaton:
+    """Aho-Corasick automaton finding all keywords in a single pass over the text"""
+
+    def __init__(self, keywords: Iterable[str]) -> None:
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[str]] = [[]]
+
+        for keyword in keywords:
+            self._add(keyword)
+        self._build_failure_links()
+
+    def _add(self, keyword: str) -> None:
+        state = 0
+        for char in keyword:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            state = next_state
+        self._out[state].append(keyword)
+
+    def _build_failure_links(self) -> None:
+        states = deque(self._goto[0].values())
+
+        while states:
+            state = states.popleft()
+            for char, next_state in self._goto[state].items():
+                states.append(next_state)
+
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._out[next_state] = self._out[next_state] + self._out[self._fail[next_state]]
+
+    def search(self, text: str) -> Set[str]:
+        goto, fail, out = self._goto, self._fail, self._out
+        found: Set[str] = set()
+
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found.update(out[state])
+
+        return found
+
+
+class RequiredLiteralIndex:
+    """Regular expressions keyed by their required literals, finds the ones that can match a text.
+
+    Every expression is listed under its longest required literal, one automaton pass over the text
+    finds all present literals, and only expressions with all their literals present are candidates.
+    Expressions without required literals are always candidates.
+    """
+
+    def __init__(self, groups: Dict[str, FilterGroup]) -> None:
+        self._always: List[Tuple[str, FilterGroup]] = []
+        self._postings: Dict[str, List[Tuple[str, FilterGroup]]] = {}
+
+        for filter_, group in groups.items():
+            if group.required:
+                key = max(group.required, key=len)
+                self._postings.setdefault(key, []).append((filter_, group))
+            else:
+                self._always.append((filter_, group))
+
+        self._automaton = LiteralAutomaton({r for g in groups.values() for r in g.required})
+
+    def candidates(self, text: str) -> List[Tuple[str, FilterGroup]]:
+        found = self._automaton.search(text.casefold())
+        result = list(self._always)
+        for key in found:
+            for filter_, group in self._postings.get(key, ()):
+                if len(group.required) == 1 or all(r in found for r in group.required):
+                    result.append((filter_, group))
+        return result
+
+
+class FilterIndex:
+    """Long-lived index of compiled filter patterns with the users of each one.
+
+    Patterns are compiled once, when they are added, and keep their compiled form
+    when only their users change, so matching a message only scans already compiled groups.
+    Plain-text filters are normalized by `normalize_text` when added and matched together
+    by a single automaton pass over the normalized message,
+    only real regular expressions are searched one by one in the original text,
+    and only those whose required literals are all present in it.
+    A regular expression that exceeds `time_budget` seconds `max_strikes` times,
+    or does not compile at all, is quarantined and no longer searched.
+    """
+
+    LOGGER = get_logger("FilterIndex")
+
+    def __init__(
+        self,
+        patterns: Iterable[PatternDTO] = (),
+        time_budget: Optional[float] = None,
+        max_strikes: int = 3
+    ) -> None:
+        self._time_budget = time_budget
+        self._max_strikes = max_strikes
+
+        self._groups: Dict[str, FilterGroup] = {}
+        self._patterns: Dict[int, PatternDTO] = {}
+
+        self._regex_groups: Dict[str, FilterGroup] = {}
+        # Different filters may share the same normalized literal, e.g. "ул Ленина" and "улица ленина"
+        self._literal_groups: Dict[str, Dict[str, FilterGroup]] = {}
+        self._automaton: Optional[LiteralAutomaton] = None
+        self._regex_index: Optional[RequiredLiteralIndex] = None
+        self._quarantined: Dict[str, FilterGroup] = {}
+
+        self.apply(patterns, ())
+
+    def __len__(self) -> int:
+        return len(self._patterns)
+
+    @property
+    def groups(self) -> List[FilterGroup]:
+        return list(self._groups.values())
+
+    @property
+    def quarantined(self) -> List[str]:
+        return list(self._quarantined)
+
+    def _quarantine(self, filter_: str, reason: str) -> None:
+        self.LOGGER.warning("Quarantining filter %r: %s", filter_, reason)
+        if self._regex_groups.pop(filter_, None) is not None:
+            self._regex_index = None
+        self._quarantined[filter_] = self._groups[filter_]
+
+    def _add_group(self, filter_: str, group: FilterGroup) -> None:
+        self._groups[filter_] = group
+
+        if group.regexp is None:
+            self._quarantine(filter_, "not a valid regular expression")
+        elif group.literal is None:
+            self._regex_groups[filter_] = group
+            self._regex_index = None
         else:
-            result[f.filter_] = FilterGroup(
-                regexp=re.compile(f.filter_, flags=re.IGNORECASE),
-                users={f.user_id}
-            )
-    return list(result.values())
+            self._literal_groups.setdefault(group.literal, {})[filter_] = group
+            self._automaton = None
+
+    def _remove_group(self, filter_: str) -> None:
+        group = self._groups.pop(filter_)
+
+        if filter_ in self._quarantined:
+            del self._quarantined[filter_]
+        elif group.literal is None:
+            del self._regex_groups[filter_]
+            self._regex_index = None
+        else:
+            same_literal = self._literal_groups[group.literal]
+            del same_literal[filter_]
+            if not same_literal:
+                del self._literal_groups[group.literal]
+                self._automaton = None
+
+    def add_pattern(self, pattern: PatternDTO) -> None:
+        """Adds the pattern or replaces its users"""
+        stored = self._patterns.get(pattern.pattern_id)
+        if stored is not None and stored.pattern != pattern.pattern:
+            self.remove_pattern(stored)
+        self._patterns[pattern.pattern_id] = pattern
+
+        group = self._groups.get(pattern.pattern)
+        if group is None:
+            literal = get_literal(pattern.pattern)
+            self._add_group(pattern.pattern, FilterGroup(
+                regexp=_compile(pattern.pattern),
+                users=pattern.user_ids,
+                literal=literal,
+                required=required_literals(pattern.pattern) if literal is None else (),
+                strikes=0
+            ))
+        else:
+            group.users = pattern.user_ids
+
+    def remove_pattern(self, pattern: PatternDTO) -> None:
+        stored = self._patterns.pop(pattern.pattern_id, None)
+        if stored is not None:
+            self._remove_group(stored.pattern)
+
+    def sync(self, patterns: Iterable[PatternDTO]) -> None:
+        """Bring the index in line with the given active patterns, compiling only new ones"""
+        added, removed = diff_patterns(self._patterns, patterns)
+        self.apply(added, removed)
+
+    def apply(self, added: Iterable[PatternDTO], removed: Iterable[PatternDTO]) -> None:
+        for p in removed:
+            self.remove_pattern(p)
+        for p in added:
+            self.add_pattern(p)
+
+    def _get_automaton(self) -> LiteralAutomaton:
+        automaton = self._automaton
+        if automaton is None:
+            automaton = self._automaton = LiteralAutomaton(self._literal_groups)
+        return automaton
+
+    def _get_regex_index(self) -> RequiredLiteralIndex:
+        regex_index = self._regex_index
+        if regex_index is None:
+            regex_index = self._regex_index = RequiredLiteralIndex(self._regex_groups)
+        return regex_index
+
+    def match(self, message: QueueMessageDTO) -> Set[UserId]:
+        return self.match_text(message.message)
 
+    def match_text(self, text: str, normalized: Optional[str] = None) -> Set[UserId]:
+        """`normalized` is `normalize_text(text)` if it is already known"""
+        # Ids are added straight from the arrays of the groups, without wrapping every one in UserId
+        result: Set[int] = set()
 
-def match_user_filters(message: QueueMessageDTO, filters: List[UserFilterDTO]) -> Set[UserId]:
-    matchers = _build_matchers(filters)
+        if self._literal_groups:
+            if normalized is None:
+                normalized = normalize_text(text)
+            for literal in self._get_automaton().search(normalized):
+                for m in self._literal_groups[literal].values():
+                    result.update(m.users)
 
-    result = set()
+        time_budget = self._time_budget
+        slow = []
+        candidates = self._get_regex_index().candidates(text) if self._regex_groups else []
+        for filter_, m in candidates:
+            started = time.perf_counter()
+            if m.regexp.search(text):  # type: ignore[union-attr]
+                result.update(m.users)
+            if time_budget is not None and time.perf_counter() - started > time_budget:
+                slow.append((filter_, m))
 
-    for m in matchers:
-        if m.regexp.search(message.message):
-            result.update(m.users)
+        for filter_, m in slow:
+            m.strikes += 1
+            if m.strikes >= self._max_strikes:
+                self._quarantine(filter_, f"exceeded the time budget {m.strikes} times")
 
-    return result
+        return cast(Set[UserId], result)
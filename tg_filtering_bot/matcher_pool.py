@@ -0,0 +1,154 @@
+import asyncio
+import multiprocessing
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Connection
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from tg_filtering_bot.crud.dto import PatternDTO
+from tg_filtering_bot.crud.schema import UserId
+from tg_filtering_bot.logger import get_logger
+from tg_filtering_bot.matcher import FilterIndex, diff_patterns, normalize_text
+from tg_filtering_bot.metrics import METRICS
+
+MATCHER_RESTARTS = METRICS.counter("matcher_restarts_total", "Matcher processes restarted after they died")
+
+
+_APPLY = "apply"
+_MATCH = "match"
+
+
+def _serve_shard(conn: Connection, time_budget: Optional[float], max_strikes: int) -> None:
+    index = FilterIndex(time_budget=time_budget, max_strikes=max_strikes)
+
+    while True:
+        try:
+            command, *args = conn.recv()
+        except EOFError:
+            return None
+
+        if command == _APPLY:
+            index.apply(*args)
+        elif command == _MATCH:
+            conn.send(index.match_text(*args))
+
+
+class MatcherPool:
+    """Filter index sharded across worker processes.
+
+    Every pattern always goes to the same shard, shards receive only pattern deltas
+    and the text of each message with its normalized form, and return user ids matched by their patterns.
+    A shard whose process died is restarted with all of its patterns.
+    """
+
+    LOGGER = get_logger("MatcherPool")
+
+    def __init__(self, processes: int, time_budget: Optional[float] = None, max_strikes: int = 3) -> None:
+        self._context = multiprocessing.get_context("spawn")
+        self._time_budget = time_budget
+        self._max_strikes = max_strikes
+
+        self._connections: List[Connection] = []
+        self._processes: List[multiprocessing.process.BaseProcess] = []
+        for _ in range(processes):
+            connection, process = self._start_process()
+            self._connections.append(connection)
+            self._processes.append(process)
+
+        self._patterns: Dict[int, PatternDTO] = {}
+        self._executor = ThreadPoolExecutor(max_workers=processes, thread_name_prefix="MatcherPool")
+        self._lock: Optional[asyncio.Lock] = None
+
+        self.LOGGER.info("Started %s matcher processes", processes)
+
+    def __len__(self) -> int:
+        return len(self._patterns)
+
+    def _start_process(self) -> Tuple[Connection, multiprocessing.process.BaseProcess]:
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_serve_shard, args=(child_conn, self._time_budget, self._max_strikes), daemon=True
+        )
+        process.start()
+        child_conn.close()
+        return parent_conn, process
+
+    def _restart(self, shard: int) -> None:
+        process = self._processes[shard]
+        self.LOGGER.error("Matcher process %s exited with code %s, restarting it", shard, process.exitcode)
+        if process.is_alive():
+            process.kill()
+        process.join()
+        self._connections[shard].close()
+
+        self._connections[shard], self._processes[shard] = self._start_process()
+        patterns = [p for p in self._patterns.values() if self._shard(p) == shard]
+        self._connections[shard].send((_APPLY, patterns, []))
+        MATCHER_RESTARTS.inc()
+
+    def _shard(self, pattern: PatternDTO) -> int:
+        # Built-in str hash differs between processes
+        return zlib.crc32(pattern.pattern.encode()) % len(self._connections)
+
+    def _apply(self, shard: int, added: List[PatternDTO], removed: List[PatternDTO]) -> None:
+        if not self._processes[shard].is_alive():
+            # The restarted shard loads the patterns including this delta
+            return self._restart(shard)
+        try:
+            self._connections[shard].send((_APPLY, added, removed))
+        except OSError:
+            self._restart(shard)
+
+    def _match(self, shard: int, text: str, normalized: str) -> Set[UserId]:
+        if not self._processes[shard].is_alive():
+            self._restart(shard)
+        try:
+            self._connections[shard].send((_MATCH, text, normalized))
+            return self._connections[shard].recv()
+        except (EOFError, OSError):
+            # The process died on this message, it is matched once more by a new one
+            self._restart(shard)
+            self._connections[shard].send((_MATCH, text, normalized))
+            return self._connections[shard].recv()
+
+    def _sync(self, patterns: Iterable[PatternDTO]) -> None:
+        added, removed = diff_patterns(self._patterns, patterns)
+
+        shard_added: List[List[PatternDTO]] = [[] for _ in self._connections]
+        shard_removed: List[List[PatternDTO]] = [[] for _ in self._connections]
+        for p in removed:
+            shard_removed[self._shard(self._patterns.pop(p.pattern_id))].append(p)
+        for p in added:
+            stored = self._patterns.get(p.pattern_id)
+            if stored is not None and self._shard(stored) != self._shard(p):
+                shard_removed[self._shard(stored)].append(stored)
+            self._patterns[p.pattern_id] = p
+            shard_added[self._shard(p)].append(p)
+
+        for shard, (shard_add, shard_remove) in enumerate(zip(shard_added, shard_removed)):
+            if shard_add or shard_remove:
+                self._apply(shard, shard_add, shard_remove)
+
+    def _get_lock(self) -> asyncio.Lock:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def sync(self, patterns: Iterable[PatternDTO]) -> None:
+        """Sends pattern deltas to the shards, large deltas of the first load are not sent on the event loop"""
+        loop = asyncio.get_event_loop()
+        async with self._get_lock():
+            await loop.run_in_executor(self._executor, self._sync, patterns)
+
+    async def match(self, text: str) -> Set[UserId]:
+        loop = asyncio.get_event_loop()
+        normalized = normalize_text(text)
+        async with self._get_lock():
+            shard_results = await asyncio.gather(*(
+                loop.run_in_executor(self._executor, self._match, shard, text, normalized)
+                for shard in range(len(self._connections))
+            ))
+
+        result: Set[UserId] = set()
+        result.update(*shard_results)
+        return result
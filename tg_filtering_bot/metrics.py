@@ -0,0 +1,242 @@
+import asyncio
+import bisect
+import multiprocessing
+import threading
+import time
+from contextlib import contextmanager
+from queue import Full, Empty
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from tg_filtering_bot.logger import get_logger
+
+
+LabelValues = Tuple[Tuple[str, str], ...]
+# {metric name: (type, help, {labels: value}, buckets)}
+Snapshot = Dict[str, Tuple[str, str, Dict[LabelValues, Any], Sequence[float]]]
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+PREFIX = "tg_filtering_bot_"
+
+
+def _labels(labels: Dict[str, Any]) -> LabelValues:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Metric:
+    TYPE = ""
+
+    def __init__(self, name: str, help_: str, lock: threading.Lock) -> None:
+        self.name = name
+        self.help = help_
+        self._lock = lock
+        self._values: Dict[LabelValues, Any] = {}
+
+    @property
+    def buckets(self) -> Sequence[float]:
+        return ()
+
+    def collect(self) -> Dict[LabelValues, Any]:
+        return {labels: self._copy(value) for labels, value in self._values.items()}
+
+    @staticmethod
+    def _copy(value: Any) -> Any:
+        return value
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def set(self, value: float, **labels: Any) -> None:
+        with self._lock:
+            self._values[_labels(labels)] = value
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name: str, help_: str, lock: threading.Lock, buckets: Sequence[float]) -> None:
+        super().__init__(name, help_, lock)
+        self._buckets = tuple(buckets)
+
+    @property
+    def buckets(self) -> Sequence[float]:
+        return self._buckets
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = _labels(labels)
+        with self._lock:
+            value_ = self._values.get(key)
+            if value_ is None:
+                # Per-bucket counts, the last one is +Inf, sum of observed values
+                value_ = self._values[key] = [[0] * (len(self._buckets) + 1), 0.0]
+            value_[0][bisect.bisect_left(self._buckets, value)] += 1
+            value_[1] += value
+
+    @contextmanager
+    def time(self, **labels: Any) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    @staticmethod
+    def _copy(value: Any) -> Any:
+        return [list(value[0]), value[1]]
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, Metric] = {}
+        self._collectors: List[Callable[[], None]] = []
+
+    def _get(self, name: str, factory: Callable[[], Metric]) -> Any:
+        metric = self._metrics.get(PREFIX + name)
+        if metric is None:
+            metric = self._metrics[PREFIX + name] = factory()
+        return metric
+
+    def counter(self, name: str, help_: str) -> Counter:
+        return self._get(name, lambda: Counter(PREFIX + name, help_, self._lock))
+
+    def gauge(self, name: str, help_: str) -> Gauge:
+        return self._get(name, lambda: Gauge(PREFIX + name, help_, self._lock))
+
+    def histogram(self, name: str, help_: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get(name, lambda: Histogram(PREFIX + name, help_, self._lock, buckets))
+
+    def add_collector(self, collector: Callable[[], None]) -> None:
+        """Called before every snapshot, e.g. to update gauges of queue sizes"""
+        self._collectors.append(collector)
+
+    def snapshot(self) -> Snapshot:
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                get_logger("Metrics").warning("Metrics collector failed: %s", e)
+
+        with self._lock:
+            return {
+                name: (metric.TYPE, metric.help, metric.collect(), metric.buckets)
+                for name, metric in self._metrics.items()
+            }
+
+
+METRICS = Registry()
+
+
+def _format_labels(labels: LabelValues, **extra: str) -> str:
+    items = list(labels) + sorted(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, v.replace("\\", "\\\\").replace('"', '\\"')) for k, v in items) + "}"
+
+
+def render(snapshots: Dict[str, Snapshot]) -> str:
+    """Prometheus text format of snapshots keyed by process name"""
+    merged: Dict[str, Tuple[str, str, List[Tuple[str, LabelValues, Any, Sequence[float]]]]] = {}
+    for process, snapshot in snapshots.items():
+        for name, (type_, help_, values, buckets) in snapshot.items():
+            samples = merged.setdefault(name, (type_, help_, []))[2]
+            samples.extend((process, labels, value, buckets) for labels, value in values.items())
+
+    lines = []
+    for name, (type_, help_, samples) in sorted(merged.items()):
+        lines.append(f"# HELP {name} {help_}")
+        lines.append(f"# TYPE {name} {type_}")
+        for process, labels, value, buckets in samples:
+            if type_ != "histogram":
+                lines.append(f"{name}{_format_labels(labels, process=process)} {value}")
+                continue
+
+            bucket_counts, total = value
+            cumulative = 0
+            for bound, count in zip(list(buckets) + [float("inf")], bucket_counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{_format_labels(labels, process=process, le=le)} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels, process=process)} {total}")
+            lines.append(f"{name}_count{_format_labels(labels, process=process)} {cumulative}")
+
+    return "\n".join(lines) + "\n"
+
+
+def create_metrics_queue() -> "multiprocessing.Queue[Tuple[str, Snapshot]]":
+    return multiprocessing.Queue(maxsize=64)
+
+
+def start_metrics_push(queue: "multiprocessing.Queue[Tuple[str, Snapshot]]", process: str, interval: float) -> None:
+    """Periodically sends snapshots of this process' metrics to the service"""
+    def push() -> None:
+        while True:
+            time.sleep(interval)
+            try:
+                queue.put_nowait((process, METRICS.snapshot()))
+            except Full:
+                pass
+
+    threading.Thread(target=push, name="MetricsPush", daemon=True).start()
+
+
+class MetricsServer:
+    """Collects metrics of all processes and serves them over HTTP or dumps them to the log"""
+
+    LOGGER = get_logger("MetricsServer")
+
+    def __init__(self, queue: Optional["multiprocessing.Queue[Tuple[str, Snapshot]]"], process: str) -> None:
+        self._queue = queue
+        self._process = process
+        self._snapshots: Dict[str, Snapshot] = {}
+
+    def _drain(self) -> None:
+        while self._queue is not None:
+            try:
+                process, snapshot = self._queue.get_nowait()
+            except Empty:
+                return None
+            self._snapshots[process] = snapshot
+
+    def render(self) -> str:
+        self._drain()
+        return render({**self._snapshots, self._process: METRICS.snapshot()})
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            # Every request gets the metrics, headers are not needed
+            await reader.readuntil(b"\r\n\r\n")
+            body = self.render().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                b"Connection: close\r\n\r\n" + body
+            )
+            await writer.drain()
+        except Exception as e:
+            self.LOGGER.warning("Metrics request failed: %s", e)
+        finally:
+            writer.close()
+
+    async def serve(self, host: str, port: int) -> None:
+        server = await asyncio.start_server(self._handle, host, port)
+        self.LOGGER.info("Serving metrics on %s:%s", host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def dump_periodic(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            self.LOGGER.info("Metrics:\n%s", self.render())
@@ -0,0 +1,118 @@
+import multiprocessing
+import re
+import time
+from multiprocessing.connection import Connection
+from typing import Any, List, Set
+
+from tg_filtering_bot.matcher import get_literal, sre_parse
+
+
+class InvalidFilterError(ValueError):
+    pass
+
+
+# Characters commonly matched by classes like \s, \w, \d or . in street names
+_COMMON_CHARS = " a1.-а"
+_INPUT_SIZES = (32, 1024)
+# Seconds to start the benchmark process, and its wall-clock limit relative to the timeout
+_STARTUP_TIMEOUT = 30.0
+_KILL_TIMEOUT_FACTOR = 3
+
+
+def _collect_literals(parsed: sre_parse.SubPattern, chars: Set[str]) -> None:
+    for op, av in parsed:
+        if op is sre_parse.LITERAL:
+            chars.add(chr(av))
+        elif op is sre_parse.IN:
+            for item_op, item_av in av:
+                if item_op is sre_parse.LITERAL:
+                    chars.add(chr(item_av))
+                elif item_op is sre_parse.RANGE:
+                    chars.update((chr(item_av[0]), chr(item_av[1])))
+        elif isinstance(av, (list, tuple)):
+            # Nested patterns of groups, repeats and branches
+            for item in av:
+                branches = item if isinstance(item, list) else [item]
+                for branch in branches:
+                    if isinstance(branch, sre_parse.SubPattern):
+                        _collect_literals(branch, chars)
+
+
+def build_adversarial_inputs(pattern: str) -> List[str]:
+    """Long runs of the characters the pattern can consume, followed by a character breaking the match,
+    which make backtracking regexes explore every way to split the run"""
+    chars: Set[str] = set(_COMMON_CHARS)
+    _collect_literals(sre_parse.parse(pattern, re.IGNORECASE), chars)
+
+    inputs = []
+    for size in _INPUT_SIZES:
+        for char in sorted(chars):
+            inputs.append(char * size + "\x00")
+        inputs.append(("".join(sorted(chars)) * size)[:size] + "\x00")
+    return inputs
+
+
+def _run_benchmark(pattern: str, timeout: float, connection: Connection) -> None:
+    regexp = re.compile(pattern, flags=re.IGNORECASE)
+    inputs = build_adversarial_inputs(pattern)
+    connection.send(None)
+
+    # CPU time of the searches, not slowed down by other processes of a loaded host
+    started = time.process_time()
+    for text in inputs:
+        regexp.search(text)
+        if time.process_time() - started > timeout:
+            break
+    connection.send(time.process_time() - started)
+
+
+def _receive(process: multiprocessing.process.BaseProcess, connection: Connection, wait: float, error: str) -> Any:
+    try:
+        if connection.poll(wait):
+            return connection.recv()
+    except EOFError:
+        process.join()
+        raise InvalidFilterError(f"Filter benchmark failed with exit code {process.exitcode}")
+
+    process.kill()
+    process.join()
+    raise InvalidFilterError(error)
+
+
+def check_filter_cost(pattern: str, timeout: float) -> None:
+    """Runs the pattern against adversarial inputs in a separate process,
+    raises InvalidFilterError if the searches take more than `timeout` seconds of CPU time.
+
+    Starting the process is not counted, the process is killed if it does not report
+    in a wall-clock limit with a generous margin over the timeout.
+    """
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_run_benchmark, args=(pattern, timeout, sender), daemon=True)
+
+    process.start()
+    sender.close()
+    too_slow = f"Filter takes more than {timeout}s on adversarial input"
+    with receiver:
+        _receive(process, receiver, _STARTUP_TIMEOUT, "Filter benchmark did not start, try again later")
+        elapsed = _receive(process, receiver, timeout * _KILL_TIMEOUT_FACTOR, too_slow)
+    process.join()
+
+    if elapsed > timeout:
+        raise InvalidFilterError(too_slow)
+
+
+def validate_filter(pattern: str, max_length: int, timeout: float) -> None:
+    """Rejects filters that do not compile or may make matching slow for everyone"""
+    if not pattern or not pattern.strip():
+        raise InvalidFilterError("Filter is empty")
+    if len(pattern) > max_length:
+        raise InvalidFilterError(f"Filter is longer than {max_length} characters")
+
+    try:
+        re.compile(pattern, flags=re.IGNORECASE)
+    except re.error as e:
+        raise InvalidFilterError(f"Filter is not a valid regular expression: {e}") from e
+
+    if get_literal(pattern) is None:
+        check_filter_cost(pattern, timeout)
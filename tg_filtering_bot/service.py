@@ -1,66 +1,488 @@
 import asyncio
+import dataclasses
+import datetime
+import multiprocessing
+import time
+from collections import defaultdict
+from typing import List, Optional, Dict, Set, Callable, Awaitable, Tuple
 
 from tg_filtering_bot.async_queue import AsyncQueue
+from tg_filtering_bot.config import settings
 from tg_filtering_bot.crud.crud import (
-    add_message_to_db,
-    mark_user_message_as_processed,
-    get_active_filters,
-    get_latest_user_chat, create_user_message
+    add_or_update_messages,
+    mark_user_messages_as_processed,
+    get_active_patterns,
+    get_latest_user_chats, create_user_messages, create_missing_user_messages,
+    get_counter,
+    get_pending_user_messages, expire_user_messages
 )
-from tg_filtering_bot.crud.dto import QueueMessageDTO, ForwardMessageDTO
+from tg_filtering_bot.crud.cache import TTLCache
+from tg_filtering_bot.crud.db import CounterName
+from tg_filtering_bot.crud.dto import (
+    QueueMessageDTO, ForwardMessageDTO, PatternDTO, DeliveryAckDTO, DeliveryStatus, IngestStatus
+)
+from tg_filtering_bot.crud.schema import MessageId, UserId
 from tg_filtering_bot.logger import get_logger
-from tg_filtering_bot.matcher import match_user_filters
+from tg_filtering_bot.matcher import FilterIndex
+from tg_filtering_bot.matcher_pool import MatcherPool
+from tg_filtering_bot.metrics import METRICS, COUNT_BUCKETS, MetricsServer, Snapshot
+
+STAGE_SECONDS = METRICS.histogram("stage_seconds", "Time spent in a stage of message processing")
+QUEUE_DEPTH = METRICS.gauge("queue_depth", "Number of messages waiting in a pipeline stage queue")
+QUEUE_BATCHES = METRICS.gauge(
+    "queue_batches", "Number of batches waiting in an inter-process queue, each of up to QUEUE_MAX_BATCH items"
+)
+ACTIVE_FILTERS = METRICS.gauge("active_filters", "Number of users subscribed to active patterns, summed over patterns")
+ACTIVE_PATTERNS = METRICS.gauge("active_patterns", "Number of distinct patterns of active filters")
+MATCHES_PER_MESSAGE = METRICS.histogram(
+    "matches_per_message", "Number of users matched by a channel message", COUNT_BUCKETS
+)
+DELIVERY_LATENCY_SECONDS = METRICS.histogram(
+    "delivery_latency_seconds", "Time between enqueueing a message for the bot and its delivery"
+)
+ACKS = METRICS.counter("delivery_acks_total", "Delivery acknowledgements received from the bot")
+IN_FLIGHT = METRICS.gauge("in_flight_messages", "User messages enqueued for the bot and not acknowledged yet")
+EXPIRED = METRICS.counter("expired_user_messages_total", "User messages given up on after OUTBOX_MAX_AGE")
+INGESTED = METRICS.counter("ingested_messages_total", "Channel messages by the result of persisting them")
+
+
+class ActiveFiltersCache:
+    """Snapshot of active filter patterns, reloaded only when the filters change counter is bumped"""
+
+    def __init__(self, check_interval: float) -> None:
+        self._check_interval = check_interval
+        self._version: Optional[int] = None
+        self._checked_at = float("-inf")
+        self._lock: Optional[asyncio.Lock] = None
+        self.patterns: List[PatternDTO] = []
+
+    async def refresh(self, sync: Callable[[List[PatternDTO]], Awaitable[None]]) -> None:
+        """Reload the snapshot if it is outdated and pass it to sync.
+
+        The version is kept only once sync succeeds, a failed sync is retried by the next call.
+        """
+        if time.monotonic() - self._checked_at < self._check_interval:
+            return None
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            if time.monotonic() - self._checked_at < self._check_interval:
+                return None
+
+            version = await get_counter(CounterName.FILTERS)
+            if version == self._version:
+                self._checked_at = time.monotonic()
+                return None
+
+            with STAGE_SECONDS.time(stage="get_active_patterns"):
+                patterns = await get_active_patterns()
+            await sync(patterns)
+            self.patterns = patterns
+            self._version = version
+            self._checked_at = time.monotonic()
+            ACTIVE_FILTERS.set(sum(len(p.user_ids) for p in self.patterns))
+            ACTIVE_PATTERNS.set(len(self.patterns))
+
+
+@dataclasses.dataclass
+class PipelineJob:
+    # Position of the message in the channel queue
+    seq: int
+    message: QueueMessageDTO
+    user_ids: Set[UserId] = dataclasses.field(default_factory=set)
+    forward_messages: List[ForwardMessageDTO] = dataclasses.field(default_factory=list)
+    # The text of a known message changed, only users it did not match before are notified
+    edited: bool = False
+    # Set when there is nothing left to do for the message
+    skip: bool = False
 
 
 class MainService:
     LOGGER = get_logger("MainService")
 
     def __init__(
-        self, channel_queue: AsyncQueue, bot_message_queue: AsyncQueue
+        self,
+        channel_queue: AsyncQueue,
+        bot_message_queue: AsyncQueue,
+        ack_queue: AsyncQueue,
+        metrics_queue: Optional["multiprocessing.Queue[Tuple[str, Snapshot]]"] = None
     ) -> None:
         self._channel_queue = channel_queue
         self._bot_message_queue = bot_message_queue
+        self._ack_queue = ack_queue
+        self._metrics_server = MetricsServer(metrics_queue, process="service")
+        self._filter_index: Optional[FilterIndex] = None
+        self._matcher_pool: Optional[MatcherPool] = None
+        if settings.MATCHER_PROCESSES > 0:
+            self._matcher_pool = MatcherPool(
+                processes=settings.MATCHER_PROCESSES,
+                time_budget=settings.FILTER_MATCH_TIME_BUDGET,
+                max_strikes=settings.FILTER_MAX_STRIKES
+            )
+        else:
+            self._filter_index = FilterIndex(
+                time_budget=settings.FILTER_MATCH_TIME_BUDGET,
+                max_strikes=settings.FILTER_MAX_STRIKES
+            )
+        self._filters_cache = ActiveFiltersCache(settings.FILTERS_CACHE_CHECK_INTERVAL)
+        # Text hashes of recent messages, history loaded on restart overlaps live messages
+        self._recent_messages: TTLCache[MessageId, int] = TTLCache(
+            maxsize=settings.SERVICE_RECENT_MESSAGES, ttl=settings.SERVICE_RECENT_MESSAGES_TTL
+        )
+        self._stages: Dict[str, asyncio.Queue[PipelineJob]] = {}
+        # Jobs of batches read from the channel queue and waiting to be stored
+        self._batched_jobs = 0
+        # User messages waiting in the bot with the time they were enqueued,
+        # a large fan-out can take longer than the outbox grace period to send
+        self._in_flight: Dict[Tuple[UserId, MessageId], float] = {}
 
-    async def process_channel_message(self, message: QueueMessageDTO) -> None:
-        self.LOGGER.info("Processing message, %s", message)
+    async def _sync_filter_index(self, patterns: List[PatternDTO]) -> None:
+        assert self._filter_index is not None
+        self._filter_index.sync(patterns)
+
+    async def match(self, message: QueueMessageDTO) -> Set[UserId]:
+        if self._matcher_pool is not None:
+            await self._filters_cache.refresh(self._matcher_pool.sync)
+            return await self._matcher_pool.match(message.message)
+
+        assert self._filter_index is not None
+        await self._filters_cache.refresh(self._sync_filter_index)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._filter_index.match, message)
+
+    async def _persist(self, job: PipelineJob) -> None:
+        await self._persist_batch([job])
+
+    async def _persist_batch(self, jobs: List[PipelineJob]) -> None:
+        """Stores a batch of channel messages with one insert, jobs of replayed messages are skipped"""
+        # Hashes to restore if the batch is not stored, None if the message was not known
+        previous: Dict[MessageId, Optional[int]] = {}
+        stored_jobs = []
+        for job in jobs:
+            message_id, text_hash = job.message.message_id, hash(job.message.message)
+            # An edit back to an earlier text is new for the database, only the latest text is compared
+            found, previous_hash = self._recent_messages.lookup(message_id)
+            if found and previous_hash == text_hash:
+                INGESTED.inc(status="recent")
+                job.skip = True
+                continue
+            # Set before the query, so that the same message in the same or a concurrent batch is skipped too
+            previous.setdefault(message_id, previous_hash if found else None)
+            self._recent_messages.set(message_id, text_hash)
+            self.LOGGER.info("Processing message, %s", job.message)
+            stored_jobs.append(job)
+
+        if not stored_jobs:
+            return None
 
         try:
-            await add_message_to_db(message)
+            statuses = await add_or_update_messages([job.message for job in stored_jobs])
         except Exception as e:
             self.LOGGER.error(e)
-            return
+            for message_id, previous_hash in previous.items():
+                if previous_hash is not None:
+                    self._recent_messages.set(message_id, previous_hash)
+                else:
+                    self._recent_messages.invalidate([message_id])
+            for job in stored_jobs:
+                job.skip = True
+            return None
 
-        active_filters = await get_active_filters()
-        loop = asyncio.get_event_loop()
-        user_ids = await loop.run_in_executor(None, match_user_filters, message, active_filters)
+        for job, status in zip(stored_jobs, statuses):
+            INGESTED.inc(status=status.value.lower())
+            if status == IngestStatus.DUPLICATE:
+                self.LOGGER.info("Message %s is already processed", job.message.message_id)
+                job.skip = True
+            job.edited = status == IngestStatus.EDITED
+
+    async def _match(self, job: PipelineJob) -> None:
+        job.user_ids = await self.match(job.message)
+        MATCHES_PER_MESSAGE.observe(len(job.user_ids))
+        job.skip = not job.user_ids
 
-        for user_id in user_ids:
+    async def _fan_out(self, job: PipelineJob) -> None:
+        if job.edited:
+            job.user_ids = await create_missing_user_messages(
+                message_id=job.message.message_id, user_ids=job.user_ids
+            )
+            if not job.user_ids:
+                job.skip = True
+                return None
+        else:
+            await create_user_messages(message_id=job.message.message_id, user_ids=job.user_ids)
+        user_chats = await get_latest_user_chats(job.user_ids)
+        enqueued_at = time.time()
+        job.forward_messages = [
+            ForwardMessageDTO(message=job.message, user_chat=user_chat, enqueued_at=enqueued_at)
+            for user_chat in user_chats.values()
+        ]
+
+    async def _deliver(self, job: PipelineJob) -> None:
+        await self._enqueue(job.forward_messages)
+
+    async def process_channel_message(self, message: QueueMessageDTO) -> None:
+        """Runs all pipeline stages for a single message"""
+        job = PipelineJob(seq=-1, message=message)
+        for stage, handler in self._handlers().items():
+            if job.skip:
+                return None
             try:
-                user_message = await create_user_message(message_id=message.message_id, user_id=user_id)
-                user_chat = await get_latest_user_chat(user_id)
+                with STAGE_SECONDS.time(stage=stage):
+                    await handler(job)
+            except Exception as e:
+                self.LOGGER.exception(e)
+                return None
+
+    async def _enqueue(self, forward_messages: List[ForwardMessageDTO]) -> None:
+        # User messages are marked as processed once the bot acknowledges the delivery
+        now = time.monotonic()
+        for forward_message in forward_messages:
+            self._in_flight[(forward_message.user_chat.user_id, forward_message.message.message_id)] = now
+        IN_FLIGHT.set(len(self._in_flight))
+
+        for i in range(0, len(forward_messages), settings.QUEUE_MAX_BATCH):
+            await self._bot_message_queue.put_many(forward_messages[i:i + settings.QUEUE_MAX_BATCH])
+
+    async def redeliver_pending(self) -> None:
+        """Enqueues again user messages that were not sent, e.g. because of a restart"""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        # Failed sends are retried by the outbox, until the message is too old to be worth sending
+        expired = await expire_user_messages(now - datetime.timedelta(seconds=settings.OUTBOX_MAX_AGE))
+        if expired:
+            EXPIRED.inc(expired)
+            self.LOGGER.warning("Gave up on %s user messages not sent within %ss", expired, settings.OUTBOX_MAX_AGE)
+
+        created_before = now - datetime.timedelta(seconds=settings.OUTBOX_GRACE_PERIOD)
+        leased_since = time.monotonic() - settings.OUTBOX_LEASE
+        self._in_flight = {key: at for key, at in self._in_flight.items() if at >= leased_since}
+        IN_FLIGHT.set(len(self._in_flight))
+
+        page = await get_pending_user_messages(created_before, limit=settings.OUTBOX_PAGE_SIZE)
+
+        while page:
+            user_chats = await get_latest_user_chats({p.user_id for p in page})
+            enqueued_at = time.time()
+
+            forward_messages = []
+            undeliverable: Dict[MessageId, Set[UserId]] = defaultdict(set)
+            in_flight = 0
+            for pending in page:
+                if (pending.user_id, pending.message.message_id) in self._in_flight:
+                    in_flight += 1
+                    continue
+                user_chat = user_chats.get(pending.user_id)
                 if user_chat:
-                    await self._bot_message_queue.put(ForwardMessageDTO(
-                        message=message,
-                        user_chat=user_chat
+                    forward_messages.append(ForwardMessageDTO(
+                        message=pending.message, user_chat=user_chat, enqueued_at=enqueued_at
                     ))
-                    await mark_user_message_as_processed(user_message)
+                else:
+                    undeliverable[pending.message.message_id].add(pending.user_id)
+
+            self.LOGGER.info(
+                "Redelivering %s messages, %s have no active chat, %s are still queued",
+                len(forward_messages), len(page) - len(forward_messages) - in_flight, in_flight
+            )
+            await self._enqueue(forward_messages)
+            for message_id, user_ids in undeliverable.items():
+                await mark_user_messages_as_processed(message_id=message_id, user_ids=user_ids)
+
+            page = await get_pending_user_messages(created_before, limit=settings.OUTBOX_PAGE_SIZE, after=page[-1])
+
+    async def run_outbox(self) -> None:
+        while True:
+            try:
+                await self.redeliver_pending()
+            except Exception as e:
+                self.LOGGER.exception(e)
+            await asyncio.sleep(settings.OUTBOX_INTERVAL)
+
+    async def process_acks(self, acks: List[DeliveryAckDTO]) -> None:
+        processed: Dict[MessageId, Set[UserId]] = defaultdict(set)
+        failed = 0
+        for ack in acks:
+            # Failed messages are redelivered by the outbox after the grace period, up to OUTBOX_MAX_AGE
+            self._in_flight.pop((ack.user_id, ack.message_id), None)
+            if ack.status == DeliveryStatus.FAILED:
+                failed += 1
+            else:
+                processed[ack.message_id].add(ack.user_id)
+
+        for message_id, user_ids in processed.items():
+            await mark_user_messages_as_processed(message_id=message_id, user_ids=user_ids)
+
+        IN_FLIGHT.set(len(self._in_flight))
+        for ack in acks:
+            ACKS.inc(status=ack.status.value)
+            DELIVERY_LATENCY_SECONDS.observe(ack.latency)
+
+        latencies = sorted(ack.latency for ack in acks)
+        self.LOGGER.info(
+            "Delivered %s messages, %s failed, latency median %.3fs, max %.3fs",
+            len(acks) - failed, failed, latencies[len(latencies) // 2], latencies[-1]
+        )
+
+    async def run_acks(self) -> None:
+        while True:
+            try:
+                acks = await self._ack_queue.get_batch(settings.QUEUE_MAX_BATCH, settings.QUEUE_BATCH_LINGER)
+                await self.process_acks(acks)
             except Exception as e:
                 self.LOGGER.exception(e)
 
+    def _handlers(self) -> Dict[str, Callable[[PipelineJob], Awaitable[None]]]:
+        return {
+            "persist": self._persist,
+            "match": self._match,
+            "fan_out": self._fan_out,
+            "deliver": self._deliver,
+        }
+
+    async def _run_stage(
+        self,
+        stage: str,
+        inbox: asyncio.Queue[PipelineJob],
+        outbox: asyncio.Queue[PipelineJob]
+    ) -> None:
+        handler = self._handlers()[stage]
+        while True:
+            job = await inbox.get()
+            if not job.skip:
+                try:
+                    with STAGE_SECONDS.time(stage=stage):
+                        await handler(job)
+                except Exception as e:
+                    self.LOGGER.exception(e)
+                    job.skip = True
+            await outbox.put(job)
+
+    async def _run_persist_stage(
+        self,
+        inbox: asyncio.Queue[List[PipelineJob]],
+        outbox: asyncio.Queue[PipelineJob]
+    ) -> None:
+        while True:
+            jobs = await inbox.get()
+            self._batched_jobs -= len(jobs)
+            try:
+                with STAGE_SECONDS.time(stage="persist"):
+                    await self._persist_batch(jobs)
+            except Exception as e:
+                self.LOGGER.exception(e)
+                for job in jobs:
+                    job.skip = True
+            for job in jobs:
+                await outbox.put(job)
+
+    async def _run_deliver_stage(self, inbox: asyncio.Queue[PipelineJob]) -> None:
+        """Enqueues messages for the bot in the order they came from the channel,
+        so every recipient gets them in that order whatever stage finished first"""
+        next_seq = 0
+        finished: Dict[int, PipelineJob] = {}
+
+        while True:
+            job = await inbox.get()
+            finished[job.seq] = job
+
+            while next_seq in finished:
+                job = finished.pop(next_seq)
+                next_seq += 1
+                if job.skip:
+                    continue
+                try:
+                    with STAGE_SECONDS.time(stage="deliver"):
+                        await self._deliver(job)
+                except Exception as e:
+                    self.LOGGER.exception(e)
+
+    def stage_depths(self) -> Dict[str, int]:
+        return {
+            "persist": self._batched_jobs,
+            **{name: stage_queue.qsize() for name, stage_queue in self._stages.items()}
+        }
+
+    def _collect_queue_depths(self) -> None:
+        for name, depth in self.stage_depths().items():
+            QUEUE_DEPTH.set(depth, queue=f"stage_{name}")
+
+        queues = {"channel": self._channel_queue, "bot_message": self._bot_message_queue, "ack": self._ack_queue}
+        for name, queue in queues.items():
+            try:
+                # Items are put in batches, the underlying queue does not know how many items it holds
+                QUEUE_BATCHES.set(queue.sync_queue.qsize(), queue=name)
+            except NotImplementedError:
+                # multiprocessing.Queue.qsize is not available on macOS
+                pass
+
+    async def run_stage_stats(self) -> None:
+        while True:
+            await asyncio.sleep(settings.SERVICE_STATS_INTERVAL)
+            self.LOGGER.info("Pipeline queue depths: %s", self.stage_depths())
+
+    def _start_pipeline(self) -> asyncio.Queue[List[PipelineJob]]:
+        stages = [
+            # The filter index is updated between matches, so matching is not concurrent
+            ("match", 1),
+            ("fan_out", settings.SERVICE_FAN_OUT_WORKERS),
+        ]
+
+        names = [name for name, _ in stages] + ["deliver"]
+        self._stages = {name: asyncio.Queue(maxsize=settings.SERVICE_STAGE_QUEUE_SIZE) for name in names}
+        # Every batch read from the channel queue is stored with one insert,
+        # messages wait there while the workers are busy and are read as larger batches
+        batches: asyncio.Queue[List[PipelineJob]] = asyncio.Queue(maxsize=settings.SERVICE_PERSIST_WORKERS)
+
+        for _ in range(settings.SERVICE_PERSIST_WORKERS):
+            asyncio.ensure_future(self._run_persist_stage(batches, self._stages["match"]))
+        queues = list(self._stages.values())
+        for (stage, workers), inbox, outbox in zip(stages, queues, queues[1:]):
+            for _ in range(workers):
+                asyncio.ensure_future(self._run_stage(stage, inbox, outbox))
+        asyncio.ensure_future(self._run_deliver_stage(self._stages["deliver"]))
+
+        return batches
+
+    def _start_metrics(self) -> None:
+        METRICS.add_collector(self._collect_queue_depths)
+        if settings.METRICS_PORT:
+            asyncio.ensure_future(self._metrics_server.serve(settings.METRICS_HOST, settings.METRICS_PORT))
+        if settings.METRICS_DUMP_INTERVAL:
+            asyncio.ensure_future(self._metrics_server.dump_periodic(settings.METRICS_DUMP_INTERVAL))
+
     async def serve(self) -> None:
+        asyncio.ensure_future(self.run_outbox())
+        asyncio.ensure_future(self.run_acks())
+        asyncio.ensure_future(self.run_stage_stats())
+        self._start_metrics()
+
+        pipeline = self._start_pipeline()
+        seq = 0
         while True:
             try:
-                message = await self._channel_queue.get()
-                await self.process_channel_message(message)
+                messages = await self._channel_queue.get_batch(
+                    settings.QUEUE_MAX_BATCH, settings.QUEUE_BATCH_LINGER
+                )
             except Exception as e:
                 self.LOGGER.exception(e)
+                continue
+
+            jobs = [PipelineJob(seq=seq + i, message=message) for i, message in enumerate(messages)]
+            seq += len(jobs)
+            self._batched_jobs += len(jobs)
+            await pipeline.put(jobs)
 
 
 def start_service(
-    channel_queue: AsyncQueue, bot_message_queue: AsyncQueue
+    channel_queue: AsyncQueue,
+    bot_message_queue: AsyncQueue,
+    ack_queue: AsyncQueue,
+    metrics_queue: Optional["multiprocessing.Queue[Tuple[str, Snapshot]]"] = None
 ) -> None:
     service = MainService(
         channel_queue=channel_queue,
-        bot_message_queue=bot_message_queue
+        bot_message_queue=bot_message_queue,
+        ack_queue=ack_queue,
+        metrics_queue=metrics_queue
     )
     asyncio.run(service.serve())
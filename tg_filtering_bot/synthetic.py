@@ -0,0 +1,148 @@
+"""Synthetic users, filters and channel messages for benchmarks and load testing
+
+    python -m tg_filtering_bot.synthetic seed --users 1000 --filters 10000
+    python -m tg_filtering_bot.synthetic messages --count 100000 > replay.jsonl
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List
+
+from tg_filtering_bot.crud.dto import QueueMessageDTO, UserFilterDTO
+from tg_filtering_bot.crud.schema import ChatId, MessageId, UserId
+
+SEED = 20230415
+
+STREETS = [
+    "ленина", "пушкина", "гагарина", "кирова", "советская", "мира", "молодежная", "центральная", "школьная",
+    "садовая", "лесная", "набережная", "октябрьская", "комсомольская", "первомайская", "победы", "калинина",
+    "чкалова", "горького", "чехова", "суворова", "кутузова", "маяковского", "лермонтова", "фрунзе",
+    "дзержинского", "свердлова", "куйбышева", "матросова", "жукова", "строителей", "заводская", "полевая",
+    "вокзальная", "береговая", "луговая", "рабочая", "речная", "новая", "солнечная",
+]
+STREET_TYPES = ["ул.", "улица", "пр.", "проспект", "пер.", "переулок"]
+REGEX_TEMPLATES = [
+    r"{street}\s+{house}\b",
+    r"(ул\.?|улица)\s*{street}",
+    r"{street}[а-я]*\s+\d+",
+    r"\b{street}\b.*\b{house}\b",
+    r"{street}\s+(д\.?\s*)?{house}",
+]
+
+
+def make_filter(rng: random.Random, regex_share: float) -> str:
+    """Street name with a house number, written as a regular expression with the given probability"""
+    street = rng.choice(STREETS)
+    house = rng.randint(1, 3000)
+    if rng.random() < regex_share:
+        return rng.choice(REGEX_TEMPLATES).format(street=street, house=house)
+    return f"{street} {house}"
+
+
+def make_filters(count: int, regex_share: float, users: int, rng: random.Random) -> List[UserFilterDTO]:
+    filters = []
+    for filter_id in range(count):
+        filter_ = make_filter(rng, regex_share)
+        filters.append(UserFilterDTO(user_id=UserId(rng.randint(1, users)), filter_=filter_, filter_id=filter_id))
+    return filters
+
+
+def make_message_text(rng: random.Random) -> str:
+    """Announcement of planned outages listing several streets, 200 to 1000 characters"""
+    day, month = rng.randint(1, 28), rng.randint(1, 12)
+    start = rng.randint(8, 12)
+    parts = [
+        f"Плановое отключение электроэнергии {day:02d}.{month:02d} с {start}:00 до {start + rng.randint(2, 8)}:00 "
+        f"в связи с ремонтом оборудования. Адреса:"
+    ]
+    for _ in range(rng.randint(3, 15)):
+        houses = ", ".join(str(rng.randint(1, 3000)) for _ in range(rng.randint(1, 8)))
+        parts.append(f"{rng.choice(STREET_TYPES)} {rng.choice(STREETS).capitalize()} {houses};")
+    parts.append("Приносим извинения за временные неудобства.")
+    return " ".join(parts)
+
+
+def iter_messages(rng: random.Random, first_id: int = 1, channel_id: int = -1000) -> Iterator[QueueMessageDTO]:
+    message_id = first_id
+    while True:
+        yield QueueMessageDTO(
+            message_id=MessageId(message_id),
+            channel_id=ChatId(channel_id),
+            message=make_message_text(rng),
+            date=datetime.now(timezone.utc)
+        )
+        message_id += 1
+
+
+def make_messages(count: int, rng: random.Random, first_id: int = 1) -> List[QueueMessageDTO]:
+    messages = iter_messages(rng, first_id)
+    return [next(messages) for _ in range(count)]
+
+
+def message_to_json(message: QueueMessageDTO) -> Dict[str, Any]:
+    return {
+        "message_id": message.message_id,
+        "channel_id": message.channel_id,
+        "message": message.message,
+        "date": message.date.isoformat(),
+    }
+
+
+def message_from_json(data: Dict[str, Any]) -> QueueMessageDTO:
+    return QueueMessageDTO(
+        message_id=MessageId(data["message_id"]),
+        channel_id=ChatId(data["channel_id"]),
+        message=data["message"],
+        date=datetime.fromisoformat(data["date"])
+    )
+
+
+async def seed_database(users: int, filters: int, regex_share: float, rng: random.Random) -> None:
+    """Users with a chat each, the chat id equals the user id, and their filters"""
+    from tg_filtering_bot.crud.crud import add_filter, create_or_update_user_chat
+    from tg_filtering_bot.crud.dto import UserChatDTO
+
+    for user_id in range(1, users + 1):
+        await create_or_update_user_chat(UserChatDTO(
+            user_id=UserId(user_id),
+            chat_id=ChatId(user_id),
+            name=f"user{user_id}",
+            username=f"user{user_id}",
+            language_code="ru"
+        ))
+
+    for user_filter in make_filters(filters, regex_share, users, rng):
+        await add_filter(user_filter)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seed", type=int, default=SEED)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    seed = commands.add_parser("seed", help="Add users and filters to the configured database")
+    seed.add_argument("--users", type=int, default=1000)
+    seed.add_argument("--filters", type=int, default=10_000)
+    seed.add_argument("--regex-share", type=float, default=0.1)
+
+    messages = commands.add_parser("messages", help="Write channel messages as JSON lines, e.g. for a replay file")
+    messages.add_argument("--count", type=int, default=10_000)
+    messages.add_argument("--first-id", type=int, default=1)
+    messages.add_argument("--channel-id", type=int, default=-1000)
+
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    if args.command == "seed":
+        asyncio.run(seed_database(args.users, args.filters, args.regex_share, rng))
+    else:
+        generated = iter_messages(rng, args.first_id, args.channel_id)
+        for _ in range(args.count):
+            sys.stdout.write(json.dumps(message_to_json(next(generated)), ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main()